@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import collections
+
+
+class AccessLog(object):
+    # the loop thread only appends a record tuple, a writer thread formats
+    # and writes them in batches. a record is
+    # (timestamp, remote address, method, uri, protocol, status code,
+    #  body bytes or None, seconds spent producing the response)
+    QUEUE_SIZE = 10000
+    BATCH_SIZE = 512
+    FLUSH_INTERVAL = 0.5
+    # past this share of the queue only every SAMPLE_RATE-th record is kept
+    SAMPLE_THRESHOLD = 0.5
+    SAMPLE_RATE = 10
+
+    TEXT_FORMAT = '[%s %s access] %s "%s %s %s" %s %s %.2fms\n'
+    DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+    def __init__(self, stream=None, json_lines=False, logger=None,
+                 queue_size=None):
+        self.stream = stream or sys.stderr
+        self.json_lines = json_lines
+        # only consulted for its level
+        self.logger = logger or logging.getLogger('zigmo_access')
+        self.queue_size = queue_size or self.QUEUE_SIZE
+        self.sample_size = int(self.queue_size * self.SAMPLE_THRESHOLD)
+
+        self.records = collections.deque()
+        self.dropped = 0
+        self.sampled = 0
+        self._skipped = 0
+        self._reported = 0
+
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._closing = False
+
+    def enabled(self):
+        return self.logger.isEnabledFor(logging.INFO)
+
+    def log(self, record):
+        # called on the loop thread, never blocks
+        records = self.records
+        size = len(records)
+        if size >= self.sample_size:
+            if size >= self.queue_size:
+                self.dropped += 1
+                return
+            self._skipped += 1
+            if self._skipped < self.SAMPLE_RATE:
+                self.sampled += 1
+                return
+            self._skipped = 0
+
+        records.append(record)
+        if self._pid != os.getpid():
+            # a forked worker needs a writer of its own
+            self.start()
+        if size + 1 == self.BATCH_SIZE:
+            self._wakeup.set()
+
+    def start(self):
+        self._pid = os.getpid()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        # writes out whatever is queued, from the loop thread at shutdown
+        if self._thread is not None and self._pid == os.getpid():
+            self._closing = True
+            self._wakeup.set()
+            self._thread.join()
+        self._thread = None
+        self._pid = None
+        self.flush()
+
+    def _run(self):
+        while not self._closing:
+            self._wakeup.wait(self.FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        records = self.records
+        while records:
+            batch = []
+            while records and len(batch) < self.BATCH_SIZE:
+                batch.append(records.popleft())
+            self.write(self.format(batch))
+
+        lost = self.dropped + self.sampled
+        if lost != self._reported:
+            self.write(self.format_loss(lost - self._reported))
+            self._reported = lost
+
+    def write(self, text):
+        try:
+            self.stream.write(text)
+            self.stream.flush()
+        except (IOError, ValueError):
+            pass
+
+    def format(self, batch):
+        if self.json_lines:
+            return ''.join(
+                json.dumps({
+                    'time': timestamp,
+                    'remote': remote,
+                    'method': method,
+                    'uri': uri,
+                    'protocol': protocol,
+                    'status': status,
+                    'bytes': size,
+                    'latency_ms': round(latency * 1000, 3),
+                }) + '\n'
+                for timestamp, remote, method, uri, protocol, status, size,
+                latency in batch
+            )
+
+        lines = []
+        # one strftime per second of records
+        last_second, date = None, None
+        for (timestamp, remote, method, uri, protocol, status, size,
+             latency) in batch:
+            second = int(timestamp)
+            if second != last_second:
+                last_second = second
+                date = time.strftime(self.DATE_FORMAT, time.localtime(second))
+            lines.append(self.TEXT_FORMAT % (
+                'I', date, remote, method, uri, protocol, status,
+                '-' if size is None else size, latency * 1000,
+            ))
+        return ''.join(lines)
+
+    def format_loss(self, lost):
+        if self.json_lines:
+            return json.dumps({'time': time.time(), 'lost': lost}) + '\n'
+        return '[W %s access] %d records dropped or sampled out\n' % (
+            time.strftime(self.DATE_FORMAT), lost)
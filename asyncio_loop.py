@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    # the asyncio backport for python 2
+    import trollius as asyncio
+
+from ioloop import IOLoop
+from concurrent import Future, register_yield_converter
+
+
+class AsyncIOLoop(IOLoop):
+    # an IOLoop running on an asyncio event loop, so zigmo shares one loop
+    # with asyncio libraries and can use any asyncio loop implementation.
+    # install() it before the server is built:
+    #
+    #   AsyncIOLoop().install()
+    #   run_server('127.0.0.1', 8888, application=app)
+    #
+    # readiness comes from add_reader/add_writer, which are level
+    # triggered, and errors show up as a readable socket
+    def __init__(self, asyncio_loop=None):
+        self.asyncio_loop = asyncio_loop or asyncio.get_event_loop()
+        self.handlers = {}
+        # fd -> events registered with asyncio_loop
+        self.events = {}
+        self.edge_triggered = False
+        self.metrics = None
+
+    def add_handler(self, fd_obj, handler, event):
+        fd = fd_obj.fileno()
+        self.handlers[fd] = (fd_obj, handler)
+        self.events[fd] = 0
+        self.update_handler(fd, event)
+
+    def update_handler(self, fd, event):
+        current = self.events[fd]
+        changed = (current ^ event) & (self.READ | self.WRITE)
+        if changed & self.READ:
+            if event & self.READ:
+                self.asyncio_loop.add_reader(
+                    fd, self._handle_events, fd, self.READ)
+            else:
+                self.asyncio_loop.remove_reader(fd)
+        if changed & self.WRITE:
+            if event & self.WRITE:
+                self.asyncio_loop.add_writer(
+                    fd, self._handle_events, fd, self.WRITE)
+            else:
+                self.asyncio_loop.remove_writer(fd)
+        self.events[fd] = event
+
+    def remove_handler(self, fd):
+        self.handlers.pop(fd, None)
+        event = self.events.pop(fd, 0)
+        if event & self.READ:
+            self.asyncio_loop.remove_reader(fd)
+        if event & self.WRITE:
+            self.asyncio_loop.remove_writer(fd)
+
+    def _handle_events(self, fd, event):
+        entry = self.handlers.get(fd)
+        if entry is None:
+            return
+        try:
+            entry[1](entry[0], event)
+        except Exception as error:
+            print('ioloop handler error: %r' % error)
+            traceback.print_exc()
+
+    def call_at(self, deadline, callback, *args, **kwargs):
+        # deadlines stay in self.time(), asyncio_loop keeps its own clock
+        if kwargs:
+            callback = functools.partial(callback, *args, **kwargs)
+            args = ()
+        return self.asyncio_loop.call_later(
+            max(0, deadline - self.time()), callback, *args)
+
+    def remove_timeout(self, timeout):
+        timeout.cancel()
+
+    def add_future_callback(self, callback, *args, **kwargs):
+        if kwargs:
+            callback = functools.partial(callback, *args, **kwargs)
+            args = ()
+        self.asyncio_loop.call_soon(callback, *args)
+
+    def add_callback_from_thread(self, callback, *args, **kwargs):
+        if kwargs:
+            callback = functools.partial(callback, *args, **kwargs)
+            args = ()
+        self.asyncio_loop.call_soon_threadsafe(callback, *args)
+
+    add_callback_from_signal = add_callback_from_thread
+
+    def pending_callbacks(self):
+        # not every asyncio loop exposes its ready queue
+        return len(getattr(self.asyncio_loop, '_ready', ()))
+
+    def start(self):
+        self._running = True
+        try:
+            self.asyncio_loop.run_forever()
+        finally:
+            self._running = False
+
+    def stop(self):
+        self._running = False
+        self.asyncio_loop.stop()
+
+
+def to_asyncio_future(future, asyncio_loop=None):
+    # an asyncio Future settled with future, cancelling it cancels future
+    result = asyncio.Future(loop=asyncio_loop or _asyncio_loop())
+
+    def copy(future):
+        if result.done():
+            return
+        if future.exc_info is not None:
+            result.set_exception(future.exception())
+        else:
+            result.set_result(future.result)
+
+    def cancelled(result):
+        if result.cancelled():
+            future.cancel()
+
+    future.add_done_callback(copy)
+    result.add_done_callback(cancelled)
+    return result
+
+
+def from_asyncio_future(future, asyncio_loop=None):
+    # a Future settled with an asyncio Future or coroutine, cancelling it
+    # cancels the asyncio side
+    future = asyncio.ensure_future(
+        future, loop=asyncio_loop or _asyncio_loop())
+    result = Future()
+
+    def copy(future):
+        if future.cancelled():
+            result.cancel()
+            return
+        error = future.exception()
+        if error is not None:
+            result.set_exc_info((
+                type(error), error, getattr(error, '__traceback__', None),
+            ))
+        else:
+            result.set_result(future.result())
+
+    future.add_done_callback(copy)
+    result.on_cancel = future.cancel
+    return result
+
+
+def _asyncio_loop():
+    io_loop = getattr(IOLoop, '_instance', None)
+    if isinstance(io_loop, AsyncIOLoop):
+        return io_loop.asyncio_loop
+    return asyncio.get_event_loop()
+
+
+def _convert_yielded(yielded):
+    # lets coroutines yield asyncio Futures and coroutines
+    if isinstance(yielded, asyncio.Future) or asyncio.iscoroutine(yielded):
+        return from_asyncio_future(yielded)
+    return None
+
+
+register_yield_converter(_convert_yielded)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import demo
+from zigmo import Application, BaseHandler, run_server
+from concurrent import Return, coroutine, sleep
+
+
+LARGE_BODY = 'x' * (1024 * 1024)
+PARKED_DELAY = 0.05
+
+
+class PlainHandler(BaseHandler):
+    @classmethod
+    def get(cls, **kwargs):
+        return 'hello world'
+
+
+class LargeHandler(BaseHandler):
+    @classmethod
+    def get(cls, **kwargs):
+        return LARGE_BODY
+
+
+class ParkedHandler(BaseHandler):
+    # waits on the loop, the connection stays parked meanwhile
+    @classmethod
+    @coroutine
+    def get(cls, **kwargs):
+        yield sleep(PARKED_DELAY)
+        raise Return('hello world')
+
+
+def main():
+    # the server under test for bench_server, access logs would only
+    # measure the terminal
+    logging.getLogger('zigmo_access').setLevel(logging.WARNING)
+    app = Application([
+        ('/plain', PlainHandler),
+        ('/large', LargeHandler),
+        ('/async', demo.AsyncHandler),
+        ('/parked', ParkedHandler),
+    ])
+    run_server('127.0.0.1', int(sys.argv[1]), application=app)
+
+
+if __name__ == '__main__':
+    main()
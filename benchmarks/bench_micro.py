@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import sys
+import socket
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ioloop import IOLoop
+from iostream import IOStream
+from concurrent import Future, Return, coroutine
+from wsgi_server import Connection, RequestParser, WSGIServer
+from zigmo import Application, BaseHandler, Request
+
+
+NUMBER = 20000
+ROUTES = 100
+YIELDS = 100
+COROUTINES = 100
+PARKED = 1000
+
+
+class BenchHandler(BaseHandler):
+    @classmethod
+    def get(cls, **kwargs):
+        return ''
+
+
+def bench_dispatch(number):
+    routes = []
+    for i in range(ROUTES):
+        if i % 2:
+            routes.append(('/api/v%d/items/<int:id>' % i, BenchHandler))
+        else:
+            routes.append(('/static/page%d' % i, BenchHandler))
+    app = Application(routes)
+    static = '/static/page%d' % (ROUTES - 2)
+    dynamic = '/api/v%d/items/42' % (ROUTES - 1)
+    return {
+        'dispatch_static': timeit.timeit(
+            lambda: app.dispatch(static, 'GET'), number=number),
+        'dispatch_dynamic': timeit.timeit(
+            lambda: app.dispatch(dynamic, 'GET'), number=number),
+    }
+
+
+def bench_headers(number):
+    environ = {
+        'PATH_INFO': '/', 'REQUEST_METHOD': 'GET', 'QUERY_STRING': '',
+        'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.url_scheme': 'http',
+        'HTTP_HOST': 'example.com',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101',
+        'HTTP_ACCEPT': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+        'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.5',
+        'HTTP_ACCEPT_ENCODING': 'gzip, deflate, br',
+        'HTTP_CONNECTION': 'keep-alive',
+        'HTTP_COOKIE': 'session=abc123; theme=dark; lang=en',
+        'HTTP_CACHE_CONTROL': 'max-age=0',
+        'HTTP_REFERER': 'http://example.com/index',
+        'HTTP_X_FORWARDED_FOR': '10.0.0.1',
+    }
+    text = (
+        'GET /index?page=2&sort=name HTTP/1.1\r\n' +
+        ''.join('%s: %s\r\n' % (key[5:].replace('_', '-').title(), value)
+                for key, value in sorted(environ.items())
+                if key.startswith('HTTP_')) +
+        '\r\n'
+    )
+
+    def lookup():
+        headers = Request(environ).headers
+        headers.get('Accept-Encoding')
+        headers.get('Host')
+        headers.get('If-None-Match')
+
+    return {
+        'request_headers': timeit.timeit(
+            lambda: Request(environ).headers, number=number),
+        'request_header_lookup': timeit.timeit(lookup, number=number),
+        'request_cookie': timeit.timeit(
+            lambda: Request(environ).cookies.get('theme'), number=number),
+        'parse_headers': timeit.timeit(
+            lambda: RequestParser.parse_headers(text), number=number),
+    }
+
+
+def bench_futures(number):
+    @coroutine
+    def resolved():
+        for i in range(YIELDS):
+            future = Future()
+            future.set_result(i)
+            yield future
+        raise Return(i)
+
+    def callback():
+        future = Future()
+        future.add_done_callback(lambda f: None)
+        future.set_result(None)
+
+    @coroutine
+    def pending(io_loop, count):
+        for i in range(count):
+            future = Future()
+            io_loop.add_future_callback(future.set_result, i)
+            yield future
+        io_loop.stop()
+
+    def run_pending():
+        # a loop can only run once, every yield goes through this one
+        IOLoop.clear_instance()
+        io_loop = IOLoop.instance()
+        started = timeit.default_timer()
+        pending(io_loop, number)
+        io_loop.start()
+        IOLoop.clear_instance()
+        return timeit.default_timer() - started
+
+    # resolved coroutines are timed per yield, scaled to number yields
+    runs = max(1, number // YIELDS)
+    return {
+        'future_callback': timeit.timeit(callback, number=number),
+        'coroutine_resolved_yield': timeit.timeit(
+            resolved, number=runs) * number / (runs * YIELDS),
+        'coroutine_pending_yield': run_pending(),
+    }
+
+
+def bench_coroutine_engine(number):
+    # reported as they are rather than per operation: yields per second
+    # of COROUTINES coroutines taking turns on the loop, and gc tracked
+    # objects kept alive per coroutine parked on a pending Future
+    @coroutine
+    def worker(io_loop, count, remaining):
+        for i in xrange(count):
+            future = Future()
+            io_loop.add_future_callback(future.set_result, i)
+            yield future
+        remaining[0] -= 1
+        if not remaining[0]:
+            io_loop.stop()
+
+    @coroutine
+    def parked(future):
+        yield future
+
+    IOLoop.clear_instance()
+    io_loop = IOLoop.instance()
+    count = max(1, number // COROUTINES)
+    remaining = [COROUTINES]
+    started = timeit.default_timer()
+    for _ in xrange(COROUTINES):
+        worker(io_loop, count, remaining)
+    io_loop.start()
+    yields_per_sec = count * COROUTINES / (timeit.default_timer() - started)
+
+    IOLoop.clear_instance()
+    IOLoop.instance()
+    waiting = [Future() for _ in xrange(PARKED)]
+    gc.collect()
+    before = len(gc.get_objects())
+    coroutines = [parked(future) for future in waiting]
+    gc.collect()
+    # the list holding the coroutines is not theirs
+    objects = len(gc.get_objects()) - before - 1
+    IOLoop.clear_instance()
+    del coroutines
+    return {
+        'coroutine_yields_per_sec': yields_per_sec,
+        'coroutine_parked_objects': float(objects) / PARKED,
+    }
+
+
+def bench_package_response(number):
+    server = WSGIServer(('127.0.0.1', 0))
+    sock, peer = socket.socketpair()
+    connection = Connection(IOStream(sock), None)
+    connection.status = '200 OK'
+    connection.keep_alive = True
+    headers = [('Content-Type', 'text/html; charset=utf-8'),
+               ('X-Powered-By', 'zigmo/0.1')]
+    body = ['<html>%s</html>' % ('x' * 1000)]
+
+    def package():
+        connection.headers = headers + server.default_headers()
+        server.package_response(body, connection)
+
+    try:
+        return {'package_response': timeit.timeit(package, number=number)}
+    finally:
+        server.ssocket.close()
+        sock.close()
+        peer.close()
+
+
+def run(scale=1.0):
+    # {'micro.<name>': microseconds per operation}
+    number = max(100, int(NUMBER * scale))
+    results = {}
+    for bench in (bench_dispatch, bench_headers, bench_futures,
+                  bench_package_response):
+        for name, seconds in bench(number).items():
+            results['micro.%s' % name] = seconds / number * 1e6
+    for name, value in bench_coroutine_engine(number).items():
+        results['micro.%s' % name] = value
+    return results
+
+
+def main():
+    for name, value in sorted(run().items()):
+        if name.endswith('_per_sec'):
+            print '%-36s %10.0f' % (name, value)
+        elif name.endswith('_objects'):
+            print '%-36s %10.1f' % (name, value)
+        else:
+            print '%-36s %10.3f us' % (name, value)
+
+
+if __name__ == '__main__':
+    main()
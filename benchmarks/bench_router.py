@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zigmo import Application, BaseHandler, HandlerNotFound
+
+
+ROUTE_COUNTS = (10, 100, 500, 1000)
+NUMBER = 20000
+
+
+class BenchHandler(BaseHandler):
+    @classmethod
+    def get(cls, **kwargs):
+        return ''
+
+
+def build_routes(count):
+    routes = []
+    for i in range(count):
+        if i % 2:
+            routes.append(('/api/v%d/items/<int:id>' % i, BenchHandler))
+        else:
+            routes.append(('/static/page%d' % i, BenchHandler))
+    return routes
+
+
+def linear_dispatch(patterns, url):
+    # the dispatch loop zigmo used before the compiled router
+    for regex in patterns:
+        if regex.match(url):
+            return regex
+    raise HandlerNotFound()
+
+
+def bench(count, number=NUMBER):
+    app = Application(build_routes(count))
+    linear = [controller.url_regex for controller in app.url_spec]
+
+    last_dynamic = '/api/v%d/items/42' % (count - 1)
+    last_static = '/static/page%d' % (count - 2)
+    results = {}
+    for name, url in (('static', last_static), ('dynamic', last_dynamic)):
+        compiled = timeit.timeit(
+            lambda: app.dispatch(url, 'GET'), number=number)
+        baseline = timeit.timeit(
+            lambda: linear_dispatch(linear, url), number=number)
+        results[name] = (baseline / number * 1e6, compiled / number * 1e6)
+    return results
+
+
+def main():
+    print '%-8s %-8s %14s %14s %8s' % (
+        'routes', 'kind', 'linear (us)', 'router (us)', 'speedup')
+    for count in ROUTE_COUNTS:
+        for name, (baseline, compiled) in sorted(bench(count).items()):
+            print '%-8d %-8s %14.2f %14.2f %7.1fx' % (
+                count, name, baseline, compiled, baseline / compiled)
+
+
+if __name__ == '__main__':
+    main()
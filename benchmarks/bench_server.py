@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import socket
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import loadgen
+
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_app.py')
+
+# name: (path, keep-alive, requests, concurrency)
+SCENARIOS = (
+    ('plain', '/plain', False, 5000, 16),
+    ('keepalive', '/plain', True, 20000, 16),
+    ('large', '/large', True, 500, 16),
+    ('coroutine', '/async', True, 20000, 16),
+    # handlers waiting 50ms each, bounded by concurrency / 0.05 req/s
+    ('parked', '/parked', True, 10000, 500),
+)
+WARMUP = 500
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start on port %d' % port)
+
+
+def run(scale=1.0):
+    # one fresh server process for all scenarios, results are
+    # {'server.<scenario>.<metric>': value}
+    port = free_port()
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen([sys.executable, APP, str(port)],
+                                  stdout=devnull, stderr=devnull)
+    results = {}
+    try:
+        wait_for(port)
+        for name, path, keep_alive, requests, concurrency in SCENARIOS:
+            loadgen.run('127.0.0.1', port, path, WARMUP, concurrency,
+                        keep_alive)
+            result = loadgen.run('127.0.0.1', port, path,
+                                 max(100, int(requests * scale)),
+                                 concurrency, keep_alive)
+            if result['errors']:
+                raise RuntimeError('%s: %d failed requests' % (
+                    name, result['errors']))
+            for metric in ('rps', 'p50_ms', 'p99_ms', 'p999_ms'):
+                results['server.%s.%s' % (name, metric)] = result[metric]
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def main():
+    for name, value in sorted(run().items()):
+        print '%-32s %12.2f' % (name, value)
+
+
+if __name__ == '__main__':
+    main()
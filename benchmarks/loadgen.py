@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import errno
+import select
+import socket
+import argparse
+import urlparse
+
+
+_EPOLLIN = select.EPOLLIN
+_EPOLLOUT = select.EPOLLOUT
+_EPOLLERR = select.EPOLLERR | select.EPOLLHUP
+
+
+class _Client(object):
+    __slots__ = ('sock', 'fd', 'pending', 'buffer', 'started', 'expected',
+                 'close_delimited', 'closing')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.pending = b''
+        self.buffer = b''
+        self.started = None
+        self.expected = None
+        self.close_delimited = False
+        self.closing = False
+
+
+def _response_size(buffer):
+    # size of the response at the start of buffer, None while it is
+    # incomplete, -1 when it ends with the connection
+    header_end = buffer.find(b'\r\n\r\n')
+    if header_end == -1:
+        return None, False
+    header_end += 4
+    headers = buffer[:header_end].lower()
+    closing = b'\r\nconnection: close' in headers
+
+    index = headers.find(b'\r\ncontent-length:')
+    if index != -1:
+        end = headers.index(b'\r\n', index + 2)
+        length = int(headers[index + 17:end])
+        return header_end + length, closing
+    if b'\r\ntransfer-encoding: chunked' in headers:
+        terminator = buffer.find(b'\r\n0\r\n\r\n', header_end - 2)
+        if terminator == -1:
+            return None, closing
+        return terminator + 7, closing
+    return -1, True
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run(host, port, path='/', requests=10000, concurrency=16,
+        keep_alive=True, timeout=60):
+    # concurrency connections kept busy on one epoll until requests
+    # responses have come back, latencies are per request in seconds
+    request = b'GET %s HTTP/1.1\r\nHost: %s:%d\r\n%s\r\n' % (
+        path, host, port, b'' if keep_alive else b'Connection: close\r\n')
+    epoll = select.epoll()
+    clients = {}
+    latencies = []
+    state = {'issued': 0, 'errors': 0}
+
+    def connect():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        err = sock.connect_ex((host, port))
+        if err not in (0, errno.EINPROGRESS):
+            sock.close()
+            state['errors'] += 1
+            return
+        client = _Client(sock)
+        clients[client.fd] = client
+        epoll.register(client.fd, _EPOLLOUT | _EPOLLERR)
+        issue(client)
+
+    def issue(client):
+        state['issued'] += 1
+        client.pending = request
+        client.buffer = b''
+        client.started = time.time()
+        client.expected = None
+
+    def close(client, failed=False):
+        epoll.unregister(client.fd)
+        client.sock.close()
+        del clients[client.fd]
+        if failed:
+            state['errors'] += 1
+        if state['issued'] < requests:
+            connect()
+
+    def finish(client, closing):
+        latencies.append(time.time() - client.started)
+        if keep_alive and not closing and state['issued'] < requests:
+            issue(client)
+            epoll.modify(client.fd, _EPOLLOUT | _EPOLLERR)
+            on_writable(client)
+        else:
+            close(client)
+
+    def on_writable(client):
+        try:
+            sent = client.sock.send(client.pending)
+        except socket.error as error:
+            if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            close(client, failed=True)
+            return
+        client.pending = client.pending[sent:]
+        if not client.pending:
+            epoll.modify(client.fd, _EPOLLIN | _EPOLLERR)
+
+    def on_readable(client):
+        try:
+            data = client.sock.recv(256 * 1024)
+        except socket.error as error:
+            if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            close(client, failed=True)
+            return
+        if not data:
+            if client.expected == -1:
+                finish(client, True)
+            else:
+                close(client, failed=True)
+            return
+
+        client.buffer += data
+        if client.expected is None or client.expected == -1:
+            client.expected, client.closing = _response_size(client.buffer)
+        if client.expected not in (None, -1) and \
+                len(client.buffer) >= client.expected:
+            finish(client, client.closing)
+
+    started = time.time()
+    for _ in range(min(concurrency, requests)):
+        connect()
+    deadline = started + timeout
+    while clients and time.time() < deadline:
+        for fd, event in epoll.poll(1):
+            client = clients.get(fd)
+            if client is None:
+                continue
+            if event & _EPOLLOUT and client.pending:
+                on_writable(client)
+            elif event & (_EPOLLIN | _EPOLLERR):
+                on_readable(client)
+    elapsed = time.time() - started
+
+    for client in clients.values():
+        client.sock.close()
+    epoll.close()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': state['errors'] + len(clients),
+        'seconds': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'p999_ms': percentile(latencies, 0.999) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP load generator')
+    parser.add_argument('url')
+    parser.add_argument('-n', '--requests', type=int, default=10000)
+    parser.add_argument('-c', '--concurrency', type=int, default=16)
+    parser.add_argument('--no-keepalive', action='store_true')
+    args = parser.parse_args()
+
+    url = urlparse.urlsplit(args.url)
+    path = url.path or '/'
+    if url.query:
+        path += '?' + url.query
+    result = run(url.hostname, url.port or 80, path, args.requests,
+                 args.concurrency, not args.no_keepalive)
+    print ('%(requests)d requests, %(errors)d errors in %(seconds).2fs, '
+           '%(rps).0f req/s, p50 %(p50_ms).2fms p99 %(p99_ms).2fms '
+           'p999 %(p999_ms).2fms' % result)
+    return 1 if result['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_micro
+import bench_server
+
+
+SUITES = {
+    'micro': bench_micro.run,
+    'server': bench_server.run,
+}
+THRESHOLD = 0.10
+
+
+def higher_is_better(name):
+    return name.endswith(('.rps', '_per_sec'))
+
+
+def compare(previous, current, threshold):
+    # [(name, before, after, change, regressed)], change is the fraction
+    # by which the result got worse, None for results new in this run
+    rows = []
+    for name in sorted(current):
+        before, after = previous.get(name), current[name]
+        if not before:
+            rows.append((name, before, after, None, False))
+            continue
+        if higher_is_better(name):
+            change = (before - after) / before
+        else:
+            change = (after - before) / before
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='zigmo benchmark suite')
+    parser.add_argument('--suite', choices=sorted(SUITES), action='append',
+                        help='run only this suite, may be repeated')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the number of operations')
+    parser.add_argument('-o', '--output', help='write results as JSON')
+    parser.add_argument('--compare', metavar='JSON',
+                        help='compare with the results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fraction a result may get worse by before it '
+                             'counts as a regression (default %(default)s)')
+    args = parser.parse_args()
+
+    results = {}
+    for suite in args.suite or sorted(SUITES):
+        results.update(SUITES[suite](args.scale))
+
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if not args.compare:
+        for name, value in sorted(results.items()):
+            print '%-36s %12.3f' % (name, value)
+        return 0
+
+    with open(args.compare) as previous:
+        previous = json.load(previous)['results']
+    rows = compare(previous, results, args.threshold)
+    print '%-36s %12s %12s %8s' % ('benchmark', 'before', 'after', 'worse')
+    for name, before, after, change, regressed in rows:
+        if change is None:
+            print '%-36s %12s %12.3f %8s' % (name, '-', after, 'new')
+            continue
+        print '%-36s %12.3f %12.3f %+7.1f%%%s' % (
+            name, before, after, change * 100,
+            '  REGRESSION' if regressed else '')
+    compared = sum(1 for row in rows if row[3] is not None)
+    regressions = sum(1 for row in rows if row[-1])
+    print '%d of %d results regressed by more than %.0f%%' % (
+        regressions, compared, args.threshold * 100)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import time
+import hashlib
+import collections
+
+from wsgi_server import environ_key
+
+
+_CACHEABLE_STATUSES = ('200', '203', '300', '301', '410')
+_NOT_MODIFIED = '304 Not Modified'
+
+
+def cache_response(ttl=None, vary=None):
+    # marks a handler method cacheable, applied below @classmethod:
+    #
+    #     @classmethod
+    #     @cache_response(ttl=5, vary=['Accept-Language'])
+    #     def get(cls, request, response): ...
+    #
+    # without a ttl the response's Cache-Control max-age is used
+    def decorator(func):
+        func.cache_response = (ttl, tuple(vary or ()))
+        return func
+    return decorator
+
+
+def _directives(value):
+    directives = {}
+    for item in value.split(','):
+        name, _, argument = item.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"')
+    return directives
+
+
+def _etag_matches(if_none_match, etag):
+    # If-None-Match uses the weak comparison
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or (tag[2:] if tag.startswith('W/') else tag) == etag:
+            return True
+    return False
+
+
+class _Entry(object):
+    __slots__ = ('primary', 'status', 'headers', 'body', 'etag', 'public',
+                 'stored', 'expires', 'size')
+
+    def __init__(self, primary, status, headers, body, etag, public, ttl):
+        self.primary = primary
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        # may answer requests with an Authorization header
+        self.public = public
+        self.stored = time.time()
+        self.expires = self.stored + ttl
+        self.size = ResponseCache.ENTRY_OVERHEAD + len(body) + sum(
+            len(name) + len(value) for name, value in headers
+        )
+
+
+class ResponseCache(object):
+    # whole GET responses, looked up before any Request/Response is built.
+    # entries are found by path and query string first, which gives the
+    # request headers the stored responses vary on, and then by the values
+    # of those headers. requests with credentials only share responses
+    # marked public or s-maxage, and with cookies only those that vary
+    # on Cookie
+    MAX_BYTES = 64 * 1024 * 1024
+    # rough per entry bookkeeping cost counted against max_bytes
+    ENTRY_OVERHEAD = 256
+
+    def __init__(self, max_bytes=None, max_entry_size=None, default_ttl=None):
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.max_entry_size = max_entry_size or self.max_bytes // 8
+        # responses of handlers without @cache_response are kept this
+        # long, None caches only the decorated ones
+        self.default_ttl = default_ttl
+
+        self.entries = collections.OrderedDict()
+        self.variants = {}
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, environ):
+        if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+            return None
+        if self.bypass(environ):
+            self.misses += 1
+            return None
+
+        primary = (environ['PATH_INFO'], environ.get('QUERY_STRING', ''))
+        variant = self.variants.get(primary)
+        if variant is None or (
+                'HTTP_COOKIE' in environ and 'HTTP_COOKIE' not in variant[0]):
+            self.misses += 1
+            return None
+
+        key = primary + tuple(environ.get(name) for name in variant[0])
+        entry = self.entries.get(key)
+        if entry is None or (
+                'HTTP_AUTHORIZATION' in environ and not entry.public):
+            self.misses += 1
+            return None
+        if entry.expires <= time.time():
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def serve(self, entry, environ, start_response):
+        headers = entry.headers + [
+            ('Age', str(int(time.time() - entry.stored))),
+        ]
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and _etag_matches(if_none_match, entry.etag):
+            start_response(_NOT_MODIFIED, [
+                (name, value) for name, value in headers
+                if name.lower() not in ('content-length', 'content-type')
+            ])
+            return []
+        # the stored buffer goes to the stream's write queue as it is
+        start_response(entry.status, headers)
+        return [entry.body]
+
+    @staticmethod
+    def bypass(environ):
+        cache_control = environ.get('HTTP_CACHE_CONTROL', '').lower()
+        return ('no-cache' in cache_control or
+                'no-cache' in environ.get('HTTP_PRAGMA', '').lower())
+
+    def store(self, environ, func, response, body):
+        # keeps a finished response and answers the request with a 304
+        # when its ETag is already known to the client
+        if environ['REQUEST_METHOD'] != 'GET':
+            return body
+        if not isinstance(body, (list, tuple)):
+            return body
+        if not response.status.startswith(_CACHEABLE_STATUSES):
+            return body
+
+        options = getattr(func, 'cache_response', None)
+        ttl, vary = options or (self.default_ttl, ())
+        if options is None and ttl is None:
+            return body
+
+        cache_control = _directives(response.get_header('Cache-Control', ''))
+        request_control = _directives(environ.get('HTTP_CACHE_CONTROL', ''))
+        if ('no-store' in cache_control or 'private' in cache_control or
+                'no-cache' in cache_control or 'no-store' in request_control):
+            return body
+        public = 'public' in cache_control or 's-maxage' in cache_control
+        if 'HTTP_AUTHORIZATION' in environ and not public:
+            return body
+        if ttl is None:
+            try:
+                ttl = int(cache_control.get(
+                    's-maxage', cache_control.get('max-age', 0)))
+            except ValueError:
+                ttl = 0
+        if ttl <= 0:
+            return body
+
+        for name in vary:
+            self.add_vary(response, name)
+        vary = self.vary_headers(response)
+        if '*' in vary or any(
+                name.lower() == 'set-cookie' for name, _ in response.headers):
+            return body
+        variant = tuple(sorted(set(environ_key(name) for name in vary)))
+        if 'HTTP_COOKIE' in environ and 'HTTP_COOKIE' not in variant:
+            return body
+
+        data = ''.join(body)
+        etag = response.get_header('ETag')
+        if etag is None:
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()[:20]
+            response.set_header('ETag', etag)
+
+        self.add(environ, variant, _Entry(
+            (environ['PATH_INFO'], environ.get('QUERY_STRING', '')),
+            response.status, response.headers, data, etag, public, ttl,
+        ))
+
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and _etag_matches(if_none_match, etag):
+            response.set_response_code(304)
+            return []
+        return [data]
+
+    @staticmethod
+    def add_vary(response, name):
+        vary = response.get_header('Vary')
+        if not vary:
+            response.set_header('Vary', name)
+        elif name.lower() not in [item.strip().lower()
+                                  for item in vary.split(',')]:
+            response.set_header('Vary', '%s, %s' % (vary, name))
+
+    @staticmethod
+    def vary_headers(response):
+        vary = response.get_header('Vary', '')
+        return [name.strip() for name in vary.split(',') if name.strip()]
+
+    def add(self, environ, variant, entry):
+        if entry.size > self.max_entry_size:
+            return
+        primary = entry.primary
+        key = primary + tuple(environ.get(name) for name in variant)
+        if key in self.entries:
+            self.remove(key)
+        known = self.variants.get(primary)
+        if known is not None and known[0] != variant:
+            # the handler changed what it varies on
+            self.purge(*primary)
+            known = None
+        if known is None:
+            known = self.variants[primary] = (variant, set())
+        known[1].add(key)
+        self.entries[key] = entry
+        self.size += entry.size
+
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        variant = self.variants.get(entry.primary)
+        if variant is not None:
+            variant[1].discard(key)
+            if not variant[1]:
+                del self.variants[entry.primary]
+
+    def purge(self, path, query_string=None):
+        # drops every stored variant of path, or only those of one query
+        # string, returns how many went
+        primaries = [
+            primary for primary in self.variants
+            if primary[0] == path and
+            (query_string is None or primary[1] == query_string)
+        ]
+        purged = 0
+        for primary in primaries:
+            for key in list(self.variants[primary][1]):
+                self.remove(key)
+                purged += 1
+        return purged
+
+    def clear(self):
+        self.entries.clear()
+        self.variants.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
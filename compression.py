@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+from concurrent import Future
+from wsgi_server import FileWrapper
+from util import SegmentedLRUCache
+
+
+# zlib writes a gzip header and trailer with this window size
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+_UNCOMPRESSED_STATUSES = ('1', '204', '206', '304')
+
+
+class GzipStream(object):
+    # compresses a streamed body chunk by chunk, whatever was written
+    # before the body has to wait is flushed so the client isn't kept
+    # waiting on bytes sitting in the compressor
+    def __init__(self, body, level):
+        self.body = body
+        self.iterator = iter(body)
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+        self.waiter = None
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.waiter is not None:
+            waiter, self.waiter = self.waiter, None
+            return waiter
+
+        while not self.finished:
+            try:
+                chunk = next(self.iterator)
+            except StopIteration:
+                self.finished = True
+                return self.compressor.flush()
+
+            if isinstance(chunk, Future):
+                pending = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+                if not pending:
+                    return chunk
+                self.waiter = chunk
+                return pending
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            data = self.compressor.compress(chunk)
+            if data:
+                return data
+        raise StopIteration()
+
+    __next__ = next
+
+    def close(self):
+        self.finished = True
+        close = getattr(self.body, 'close', None)
+        if close is not None:
+            close()
+
+
+class GzipCompressor(object):
+    # Application(urls, compressor=GzipCompressor(level=6))
+    LEVEL = 6
+    MIN_SIZE = 1024
+    CACHE_SIZE = 128
+    # bodies compressed once and kept are those carrying an ETag, up to
+    # this size, anything larger is compressed as a stream every time
+    MAX_CACHED_SIZE = 1024 * 1024
+    COMPRESSIBLE_TYPES = (
+        'text/',
+        'application/json',
+        'application/javascript',
+        'application/x-javascript',
+        'application/xml',
+        'application/xhtml+xml',
+        'image/svg+xml',
+    )
+    COMPRESSIBLE_SUFFIXES = ('+json', '+xml')
+
+    def __init__(self, level=None, min_size=None, cache_size=None,
+                 compressible_types=None):
+        self.level = self.LEVEL if level is None else level
+        self.min_size = self.MIN_SIZE if min_size is None else min_size
+        self.compressible_types = tuple(
+            compressible_types or self.COMPRESSIBLE_TYPES
+        )
+        self.cache = SegmentedLRUCache(cache_size or self.CACHE_SIZE)
+
+    def compress(self, request, response, body):
+        # returns the body to send, rewriting the response headers when
+        # it's compressed
+        if not self.compressible(response):
+            return body
+
+        if isinstance(body, (list, tuple)):
+            size = sum(len(data) for data in body)
+        else:
+            size = response.get_header('Content-Length')
+            size = None if size is None else int(size)
+        if size is not None and size < self.min_size:
+            return body
+
+        self.add_vary(response)
+        accept_encoding = request.headers.get('ACCEPT-ENCODING')
+        if not self.accepts_gzip(accept_encoding):
+            return body
+
+        etag = response.get_header('ETag')
+        key = None
+        if etag is not None and size is not None:
+            key = (request.url, etag, self.level)
+        if key is not None:
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                self.close_body(body)
+                return self.fixed(response, etag, compressed)
+
+        whole = isinstance(body, (list, tuple)) or (
+            isinstance(body, FileWrapper) and size is not None and
+            size <= self.MAX_CACHED_SIZE
+        )
+        if not whole:
+            response.clear_header('Content-Length')
+            self.set_encoding(response, etag)
+            return GzipStream(body, self.level)
+
+        try:
+            data = ''.join(body)
+        finally:
+            self.close_body(body)
+        compressed = self.compress_data(data)
+        if key is not None and len(compressed) <= self.MAX_CACHED_SIZE:
+            self.cache.set(key, compressed)
+        return self.fixed(response, etag, compressed)
+
+    def compress_data(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, _GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def fixed(self, response, etag, compressed):
+        self.set_encoding(response, etag)
+        response.set_header('Content-Length', len(compressed))
+        return [compressed]
+
+    @staticmethod
+    def set_encoding(response, etag):
+        response.set_header('Content-Encoding', 'gzip')
+        if etag is not None and not etag.startswith('W/'):
+            # the compressed bytes differ from the ones the tag stood for
+            response.set_header('ETag', 'W/' + etag)
+
+    @staticmethod
+    def add_vary(response):
+        vary = response.get_header('Vary')
+        if not vary:
+            response.set_header('Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            response.set_header('Vary', vary + ', Accept-Encoding')
+
+    @staticmethod
+    def close_body(body):
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+    def compressible(self, response):
+        if response.status.startswith(_UNCOMPRESSED_STATUSES):
+            return False
+        if response.get_header('Content-Encoding') is not None:
+            return False
+        content_type = response.get_header('Content-Type', '')
+        content_type = content_type.split(';', 1)[0].strip().lower()
+        return (content_type.startswith(self.compressible_types) or
+                content_type.endswith(self.COMPRESSIBLE_SUFFIXES))
+
+    @staticmethod
+    def accepts_gzip(accept_encoding):
+        if not accept_encoding:
+            return False
+        codings = {}
+        for item in accept_encoding.split(','):
+            coding, _, params = item.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            codings[coding.strip().lower()] = quality
+
+        for coding in ('gzip', 'x-gzip'):
+            if coding in codings:
+                return codings[coding] > 0
+        return codings.get('*', 0) > 0
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import Queue
+import cPickle
+import datetime
 import functools
+import threading
+import traceback
+import multiprocessing
 
 try:
     from backports_abc import Generator as GeneratorType
@@ -17,22 +23,83 @@ class Return(Exception):
         self.value = value
 
 
+class CancelledError(Exception):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+# shared by every Future without callbacks, replaced on the first one
+_NO_CALLBACKS = ()
+
+
 class Future(object):
+    # a Future is settled once, by set_result, set_exception or cancel,
+    # later attempts are ignored so that whoever produces a cancelled
+    # Future can still settle it without checking
+    __slots__ = ('result', 'exc_info', 'done', 'cancelled', 'callbacks',
+                 'on_cancel')
+
     def __init__(self):
         self.result = None
         self.exc_info = None
         self.done = False
-        self.callbacks = []
+        self.cancelled = False
+        self.callbacks = _NO_CALLBACKS
+        # called by cancel() to cancel whatever this Future waits on
+        self.on_cancel = None
 
     def set_result(self, result):
+        if self.done:
+            return
         self.result = result
         self.done = True
-        for cb in self.callbacks:
-            cb(self)
+        callbacks = self.callbacks
+        if callbacks:
+            self.callbacks = _NO_CALLBACKS
+            for cb in callbacks:
+                cb(self)
+
+    def set_exception(self, exception):
+        exc_info = sys.exc_info()
+        if exc_info[1] is not exception:
+            exc_info = (type(exception), exception, None)
+        self.set_exc_info(exc_info)
+
+    def set_exc_info(self, exc_info):
+        if self.done:
+            return
+        self.exc_info = exc_info
+        self.done = True
+        callbacks = self.callbacks
+        if callbacks:
+            self.callbacks = _NO_CALLBACKS
+            for cb in callbacks:
+                cb(self)
+
+    def exception(self):
+        if self.exc_info is None:
+            return None
+        return self.exc_info[1]
+
+    def cancel(self):
+        # fails a pending Future with CancelledError
+        if self.done:
+            return False
+        self.cancelled = True
+        self.set_exception(CancelledError())
+        if self.on_cancel is not None:
+            on_cancel, self.on_cancel = self.on_cancel, None
+            on_cancel()
+        return True
 
     def add_done_callback(self, fn):
         if self.done:
             fn(self)
+        elif self.callbacks is _NO_CALLBACKS:
+            self.callbacks = [fn]
         else:
             self.callbacks.append(fn)
 
@@ -40,7 +107,120 @@ class Future(object):
 _null_future = Future()
 
 
+def _copy_future(source, target):
+    if source.exc_info is not None:
+        target.set_exc_info(source.exc_info)
+    else:
+        target.set_result(source.result)
+
+
+# callables turning what else a coroutine may yield into a Future,
+# returning None for anything they do not handle
+_yield_converters = []
+
+
+def register_yield_converter(convert):
+    _yield_converters.append(convert)
+
+
+def convert_yielded(yielded):
+    if isinstance(yielded, Future):
+        return yielded
+    if isinstance(yielded, (list, dict)):
+        return multi_future(yielded)
+    for convert in _yield_converters:
+        future = convert(yielded)
+        if future is not None:
+            return future
+    raise TypeError('cannot yield %r from a coroutine' % (yielded,))
+
+
+def multi_future(children, fail_fast=False):
+    # a list or dict of Futures to a Future of their results in the same
+    # shape. it waits for every child and fails with the first failure
+    # in order, or with fail_fast as soon as any child fails. cancelling
+    # it cancels the children
+    if isinstance(children, dict):
+        keys = list(children)
+        futures = [convert_yielded(children[key]) for key in keys]
+    else:
+        keys = None
+        futures = [convert_yielded(child) for child in children]
+    future = Future()
+    if not futures:
+        future.set_result({} if keys is not None else [])
+        return future
+
+    unfinished = set(futures)
+
+    def callback(child):
+        unfinished.discard(child)
+        if future.done:
+            if child.exc_info is not None and not child.cancelled:
+                print 'multi future error: %r' % child.exc_info[1]
+            return
+        if fail_fast and child.exc_info is not None:
+            future.set_exc_info(child.exc_info)
+            return
+        if unfinished:
+            return
+        failed = [f for f in futures if f.exc_info is not None]
+        if failed:
+            # coalesced children share their failure, it is raised once
+            errors = set(f.exc_info[1] for f in failed)
+            errors.discard(failed[0].exc_info[1])
+            for error in errors:
+                print 'multi future error: %r' % error
+            future.set_exc_info(failed[0].exc_info)
+            return
+        results = [f.result for f in futures]
+        if keys is not None:
+            results = dict(zip(keys, results))
+        future.set_result(results)
+
+    def cancel_children():
+        for f in futures:
+            f.cancel()
+    future.on_cancel = cancel_children
+
+    listening = set()
+    for f in futures:
+        if f not in listening:
+            listening.add(f)
+            f.add_done_callback(callback)
+    return future
+
+
+def with_timeout(future, deadline, io_loop=None):
+    # deadline is an io_loop.time() or a timedelta from now. past it the
+    # returned Future fails with TimeoutError and future is cancelled
+    io_loop = io_loop or IOLoop.instance()
+    if isinstance(deadline, datetime.timedelta):
+        deadline = io_loop.time() + deadline.total_seconds()
+    result = Future()
+    if future.done:
+        _copy_future(future, result)
+        return result
+
+    def on_timeout():
+        result.set_exception(TimeoutError('timed out'))
+        future.cancel()
+    timeout = io_loop.call_at(deadline, on_timeout)
+
+    def on_done(future):
+        io_loop.remove_timeout(timeout)
+        _copy_future(future, result)
+    future.add_done_callback(on_done)
+    result.on_cancel = future.cancel
+    return result
+
+
 class Runner(object):
+    # a yielded Future that is already done is sent straight back into
+    # the generator, a pending one resumes it from the next loop pass
+    __slots__ = ('gen', 'result_future', 'future', 'running', 'finished',
+                 'ioloop')
+
     def __init__(self, gen, result_future, first_yielded):
         self.gen = gen
         self.result_future = result_future
@@ -49,47 +229,39 @@ class Runner(object):
         self.finished = False
 
         self.ioloop = IOLoop.instance()
+        # cancelling the coroutine cancels what it is waiting on, which
+        # throws CancelledError in at the yield
+        result_future.on_cancel = self.cancel
 
         if self.handle_yield(first_yielded):
             self.run()
 
-    def multi_future(self, yielded):
-        children = yielded
-        future = Future()
-        if not children:
-            future.set_result([])
-
-        unfinished_children = set(children)
-
-        def callback(f):
-            unfinished_children.remove(f)
-            if not unfinished_children:
-                result_list = []
-                for f in children:
-                    try:
-                        result_list.append(f.result)
-                    except Exception as e:
-                        print 'multi future error:%r' % e
-                if not future.done:
-                    future.set_result(result_list)
+    def cancel(self):
+        if not self.finished and self.future is not None:
+            self.future.cancel()
 
-        listening = set()
-        for f in children:
-            if f not in listening:
-                listening.add(f)
-                f.add_done_callback(callback)
-        return future
+    def finish(self):
+        self.finished = True
+        self.future = _null_future
+        # a settled Future should not keep the finished generator alive
+        self.result_future.on_cancel = None
 
     def handle_yield(self, yielded):
-        if isinstance(yielded, (list, dict)):
-            self.future = self.multi_future(yielded)
-        else:
-            self.future = yielded
+        if not isinstance(yielded, Future):
+            try:
+                yielded = convert_yielded(yielded)
+            except Exception:
+                # thrown back in at the yield
+                yielded = Future()
+                yielded.set_exc_info(sys.exc_info())
+        self.future = yielded
+        if yielded.done:
+            return True
+        yielded.add_done_callback(self.on_future_done)
+        return False
 
-        if not self.future.done:
-            self.ioloop.add_future(self.future, lambda f: self.run())
-            return False
-        return True
+    def on_future_done(self, future):
+        self.ioloop.add_future_callback(self.run)
 
     def run(self):
         if self.running or self.finished:
@@ -103,14 +275,20 @@ class Runner(object):
                     return
                 self.future = None
                 try:
-                    value = future.result
-                    yielded = self.gen.send(value)
+                    if future.exc_info is None:
+                        yielded = self.gen.send(future.result)
+                    else:
+                        yielded = self.gen.throw(*future.exc_info)
                 except (StopIteration, Return) as e:
-                    self.finished = True
-                    self.future = _null_future
+                    self.finish()
                     self.result_future.set_result(getattr(e, 'value', None))
                     self.result_future = None
                     return
+                except Exception:
+                    self.finish()
+                    self.result_future.set_exc_info(sys.exc_info())
+                    self.result_future = None
+                    return
                 if not self.handle_yield(yielded):
                     return
         finally:
@@ -127,7 +305,7 @@ def coroutine(func):
         except (StopIteration, Return) as e:
             result = getattr(e, 'value', None)
         except Exception:
-            future.exc_info = sys.exc_info()
+            future.set_exc_info(sys.exc_info())
             return future
         else:
             if isinstance(result, GeneratorType):
@@ -136,7 +314,7 @@ def coroutine(func):
                 except (StopIteration, Return) as e:
                     future.set_result(getattr(e, 'value', None))
                 except Exception:
-                    future.exc_info = sys.exc_info()
+                    future.set_exc_info(sys.exc_info())
                 else:
                     # result is generator, yielded is Future
                     Runner(result, future, yielded)
@@ -148,3 +326,254 @@ def coroutine(func):
         future.done = True
         return future
     return wrapper
+
+
+def sleep(seconds, io_loop=None):
+    # a Future that resolves after seconds, for coroutines to yield
+    future = Future()
+    (io_loop or IOLoop.instance()).call_later(
+        seconds, future.set_result, None,
+    )
+    return future
+
+
+class SingleFlight(object):
+    # callers asking for a key while a call for it is in flight share that
+    # call's result, each through a Future of its own so that cancelling
+    # one of them leaves the call running for the others. a successful
+    # result may be kept for grace seconds after it lands, failures are
+    # dropped at once
+    def __init__(self, grace=0, io_loop=None):
+        self.grace = grace
+        self.io_loop = io_loop
+        self.flights = {}
+        self.calls = 0
+        self.saved = 0
+
+    def call(self, key, fn, *args, **kwargs):
+        future = self.flights.get(key)
+        if future is not None:
+            self.saved += 1
+            return self._share(future)
+
+        self.calls += 1
+        future = fn(*args, **kwargs)
+        if not isinstance(future, Future):
+            result, future = future, Future()
+            future.set_result(result)
+
+        self.flights[key] = future
+        future.add_done_callback(functools.partial(self._landed, key))
+        return self._share(future)
+
+    @staticmethod
+    def _share(future):
+        result = Future()
+        future.add_done_callback(
+            functools.partial(_copy_future, target=result)
+        )
+        return result
+
+    def _landed(self, key, future):
+        if self.grace and future.exc_info is None:
+            io_loop = self.io_loop or IOLoop.instance()
+            io_loop.call_later(
+                self.grace, functools.partial(self.forget, key, future),
+            )
+        else:
+            self.forget(key, future)
+
+    def forget(self, key, future=None):
+        if future is None or self.flights.get(key) is future:
+            self.flights.pop(key, None)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'saved': self.saved,
+            'in_flight': len(self.flights),
+        }
+
+
+def coalesce(key_fn=None, grace=0):
+    # @coalesce(lambda cls, user_id: user_id) over a coroutine, the
+    # decorated function's SingleFlight is available as .flight
+    def coalesce_decorator(fn):
+        flight = SingleFlight(grace)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if key_fn is not None:
+                key = key_fn(*args, **kwargs)
+            else:
+                key = (args, tuple(sorted(kwargs.items())))
+            return flight.call(key, fn, *args, **kwargs)
+        wrapper.flight = flight
+        return wrapper
+    return coalesce_decorator
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+class Executor(object):
+    def __init__(self, max_queue_size=0):
+        self.max_queue_size = max_queue_size
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self):
+        # submitted tasks that have not completed yet, queued or running
+        return self._pending
+
+    def execute(self, fn, args, kwargs, done):
+        with self._lock:
+            if self.max_queue_size and self._pending >= self.max_queue_size:
+                raise ExecutorBusy('%d tasks pending' % self._pending)
+            self._pending += 1
+
+        def task_done(result, exc_info):
+            with self._lock:
+                self._pending -= 1
+            done(result, exc_info)
+
+        self._execute(fn, args, kwargs, task_done)
+
+    def submit(self, fn, *args, **kwargs):
+        return IOLoop.instance().run_in_executor(
+            self, functools.partial(fn, *args, **kwargs),
+        )
+
+    def _execute(self, fn, args, kwargs, done):
+        raise NotImplementedError()
+
+    def shutdown(self, wait=True):
+        raise NotImplementedError()
+
+
+class ThreadPoolExecutor(Executor):
+    def __init__(self, max_workers=4, max_queue_size=0):
+        super(ThreadPoolExecutor, self).__init__(max_queue_size)
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _execute(self, fn, args, kwargs, done):
+        self._queue.put((fn, args, kwargs, done))
+        if len(self._threads) < self.max_workers:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            fn, args, kwargs, done = task
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                done(None, sys.exc_info())
+            else:
+                done(result, None)
+
+    def shutdown(self, wait=True):
+        for thread in self._threads:
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+
+def _call_in_process(payload):
+    # the outcome goes back pickled here, a value the pool fails to pickle
+    # would be dropped without its callback ever running. tracebacks can't
+    # be pickled, the formatted text is sent instead
+    try:
+        fn, args, kwargs = cPickle.loads(payload)
+        return True, cPickle.dumps(
+            fn(*args, **kwargs), cPickle.HIGHEST_PROTOCOL,
+        )
+    except Exception as error:
+        formatted = traceback.format_exc()
+        try:
+            return False, cPickle.dumps(
+                (error, formatted), cPickle.HIGHEST_PROTOCOL,
+            )
+        except Exception:
+            return False, cPickle.dumps(
+                (RuntimeError(repr(error)), formatted),
+                cPickle.HIGHEST_PROTOCOL,
+            )
+
+
+class ProcessPoolExecutor(Executor):
+    def __init__(self, max_workers=None, max_queue_size=0):
+        super(ProcessPoolExecutor, self).__init__(max_queue_size)
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self._pool = multiprocessing.Pool(self.max_workers)
+
+    @property
+    def queue_depth(self):
+        return max(0, self._pending - self.max_workers)
+
+    def _execute(self, fn, args, kwargs, done):
+        # e.g. a bound method from run_on_executor fails here, on the Future
+        try:
+            payload = cPickle.dumps(
+                (fn, args, kwargs), cPickle.HIGHEST_PROTOCOL,
+            )
+        except Exception:
+            done(None, sys.exc_info())
+            return
+
+        def callback(outcome):
+            ok, data = outcome
+            try:
+                value = cPickle.loads(data)
+            except Exception:
+                done(None, sys.exc_info())
+                return
+            if ok:
+                done(value, None)
+                return
+            error, formatted = value
+            error.remote_traceback = formatted
+            done(None, (type(error), error, None))
+
+        self._pool.apply_async(_call_in_process, (payload,), callback=callback)
+
+    def shutdown(self, wait=True):
+        self._pool.close()
+        if wait:
+            self._pool.join()
+
+
+def run_on_executor(*args, **kwargs):
+    def run_on_executor_decorator(fn):
+        executor = kwargs.get('executor', 'executor')
+
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            return IOLoop.instance().run_in_executor(
+                getattr(self, executor),
+                functools.partial(fn, self, *args, **kwargs),
+            )
+        return wrapper
+
+    if args and kwargs:
+        raise ValueError('cannot combine positional and keyword args')
+    if len(args) == 1:
+        return run_on_executor_decorator(args[0])
+    elif len(args) != 0:
+        raise ValueError('expected 1 argument, got %d' % len(args))
+    return run_on_executor_decorator
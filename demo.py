@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from zigmo import Application, BaseHandler, run_server
-from concurrent import Return, coroutine
+from concurrent import Return, coroutine, sleep
 
 
 class AppHandler(BaseHandler):
@@ -23,10 +23,21 @@ class AsyncHandler(BaseHandler):
         raise Return(result)
 
 
+class SleepHandler(BaseHandler):
+    # the connection is parked while the handler waits, the loop keeps
+    # serving everyone else
+    @classmethod
+    @coroutine
+    def get(cls, *args, **kwargs):
+        yield sleep(1)
+        raise Return('slept for a second')
+
+
 if __name__ == '__main__':
     app = Application([
         ('/app', AppHandler),
         ('/\d+', AppHandler),
         ('/s', AsyncHandler),
+        ('/sleep', SleepHandler),
     ])
     run_server('0.0.0.0', 8080, application=app)
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import urlparse
+import functools
+import collections
+
+from ioloop import IOLoop
+from iostream import IOStream, StreamClosedError
+from concurrent import Future, CancelledError, ThreadPoolExecutor
+
+
+class HTTPClientError(Exception):
+    def __init__(self, code, message):
+        super(HTTPClientError, self).__init__(code, message)
+        self.code = code
+        self.message = message
+
+
+class HTTPRequest(object):
+    def __init__(self, url, method='GET', headers=None, body=None,
+                 connect_timeout=None, request_timeout=None,
+                 streaming_callback=None):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme != 'http':
+            raise ValueError('unsupported url scheme: %r' % parsed.scheme)
+
+        self.url = url
+        self.method = method.upper()
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.netloc = parsed.netloc
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+        self.headers = headers or {}
+        self.body = body
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.streaming_callback = streaming_callback
+        self.start_time = time.time()
+
+    def to_bytes(self):
+        lines = ['%s %s HTTP/1.1' % (self.method, self.path)]
+        headers = {'Host': self.netloc, 'Connection': 'keep-alive'}
+        headers.update(self.headers)
+        if self.body is not None:
+            headers['Content-Length'] = str(len(self.body))
+        for name, value in headers.items():
+            lines.append('%s: %s' % (name, value))
+        lines.append('\r\n')
+        return '\r\n'.join(lines) + (self.body or '')
+
+
+class HTTPResponse(object):
+    def __init__(self, request, code, reason, headers, body):
+        self.request = request
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.request_time = time.time() - request.start_time
+
+
+class _HostPool(object):
+    def __init__(self):
+        self.active = 0
+        self.idle = collections.deque()
+        self.idle_timeouts = {}
+        self.waiting = collections.deque()
+
+
+class _HTTPConnection(object):
+    READ_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_LINE = 1024
+    # the server may have acted on a request that got no response, only
+    # these are safe to send again
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, client, pool, request, future):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.pool = pool
+        self.request = request
+        self.future = future
+
+        self.stream = None
+        self.reused = False
+        self.started = False
+        self.finished = False
+
+        self.code = None
+        self.reason = None
+        self.headers = None
+        self.chunks = []
+        self.body_size = 0
+        self.remaining = None
+        self.chunk_state = None
+        self.keep_alive = False
+
+        self._timeout = self.io_loop.call_later(
+            request.request_timeout, self._on_timeout,
+        )
+        self._connect_timeout = None
+        # cancelling the fetch, e.g. through with_timeout, gives back the
+        # connection or the place in the queue
+        future.on_cancel = self._on_cancel
+
+    def start(self):
+        self.started = True
+        self.pool.active += 1
+        stream = self.client._pop_idle(self.pool)
+        if stream is not None:
+            self.reused = True
+            self.stream = stream
+            self._send_request()
+        else:
+            self._connect()
+
+    def _connect(self):
+        self._connect_timeout = self.io_loop.call_later(
+            self.request.connect_timeout, self._on_connect_timeout,
+        )
+        future = self.client.resolve(self.request.host, self.request.port)
+        future.add_done_callback(self._on_resolve)
+
+    def _on_resolve(self, future):
+        if self.finished:
+            return
+        if future.exc_info is not None:
+            self._fail(future.exception())
+            return
+
+        family, address = future.result
+        self.stream = IOStream(
+            socket.socket(family, socket.SOCK_STREAM), self.io_loop,
+            max_buffer_size=self.client.max_body_size,
+            read_chunk_size=self.READ_CHUNK_SIZE,
+        )
+        self.stream.connect(address).add_done_callback(self._on_connect)
+
+    def _on_connect(self, future):
+        if self._failed(future):
+            return
+        self.io_loop.remove_timeout(self._connect_timeout)
+        self._connect_timeout = None
+        self._send_request()
+
+    def _send_request(self):
+        self.stream.write(self.request.to_bytes())
+        self.stream.read_until(
+            b'\r\n\r\n', max_bytes=self.client.max_header_size,
+        ).add_done_callback(self._on_headers)
+
+    def _on_connect_timeout(self):
+        self._connect_timeout = None
+        self._fail(HTTPClientError(599, 'Connect timeout'))
+
+    def _on_timeout(self):
+        self._timeout = None
+        self._abort(HTTPClientError(599, 'Timeout'))
+
+    def _on_cancel(self):
+        self._abort(CancelledError())
+
+    def _abort(self, error):
+        if not self.started:
+            self.pool.waiting.remove(self)
+            self.client._queued -= 1
+        self._fail(error)
+
+    def _failed(self, future):
+        if self.finished:
+            return True
+        if future.exc_info is None:
+            return False
+
+        error = future.exception()
+        if (self.reused and self.code is None and
+                self.request.method in self.IDEMPOTENT_METHODS and
+                not self.stream.read_buffer_size and
+                isinstance(error, (StreamClosedError, socket.error))):
+            # the pooled connection was closed by the server while idle,
+            # nothing of a response came back so the request is sent again
+            self.reused = False
+            self.stream.close()
+            self._connect()
+            return True
+        self._fail(error)
+        return True
+
+    def _on_headers(self, future):
+        if self._failed(future):
+            return
+
+        lines = future.result.split('\r\n')
+        try:
+            version, code, reason = (lines[0].split(' ', 2) + [''])[:3]
+            code = int(code)
+        except ValueError:
+            self._fail(HTTPClientError(599, 'malformed status line'))
+            return
+
+        if 100 <= code < 200:
+            self.stream.read_until(
+                b'\r\n\r\n', max_bytes=self.client.max_header_size,
+            ).add_done_callback(self._on_headers)
+            return
+
+        headers = {}
+        for line in lines[1:]:
+            if ':' not in line:
+                continue
+            name, value = line.split(':', 1)
+            name = name.strip().upper()
+            value = value.strip()
+            if name in headers:
+                headers[name] += ',' + value
+            else:
+                headers[name] = value
+
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        connection = headers.get('CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+
+        if self.request.method == 'HEAD' or code in (204, 304):
+            self._finish()
+        elif 'chunked' in headers.get('TRANSFER-ENCODING', '').lower():
+            self.chunk_state = 'size'
+            self._read_chunked()
+        elif 'CONTENT-LENGTH' in headers:
+            try:
+                self.remaining = int(headers['CONTENT-LENGTH'])
+            except ValueError:
+                self._fail(HTTPClientError(599, 'bad Content-Length'))
+                return
+            self._read_fixed()
+        else:
+            # the body is delimited by the server closing the connection
+            self.keep_alive = False
+            self._read_fixed()
+
+    def _on_chunk(self, data):
+        self.body_size += len(data)
+        if self.body_size > self.client.max_body_size:
+            self._fail(HTTPClientError(599, 'response body too large'))
+            return False
+        if self.request.streaming_callback is not None:
+            self.request.streaming_callback(data)
+        else:
+            self.chunks.append(data)
+        return True
+
+    def _read_fixed(self, future=None):
+        # loops while reads complete from the buffer, recursion only
+        # happens through the ioloop
+        while True:
+            if future is not None:
+                if (self.remaining is None and
+                        isinstance(future.exception(), StreamClosedError)):
+                    self._finish()
+                    return
+                if self._failed(future):
+                    return
+                if not self._on_chunk(future.result):
+                    return
+                if self.remaining is not None:
+                    self.remaining -= len(future.result)
+
+            if self.remaining == 0:
+                self._finish()
+                return
+            future = self.stream.read_bytes(
+                min(self.remaining or self.READ_CHUNK_SIZE,
+                    self.READ_CHUNK_SIZE),
+                partial=True,
+            )
+            if not future.done:
+                future.add_done_callback(self._read_fixed)
+                return
+
+    def _read_chunked(self, future=None):
+        while True:
+            if future is not None:
+                if self._failed(future):
+                    return
+                data = future.result
+                if self.chunk_state == 'size':
+                    try:
+                        size = int(data.split(';', 1)[0].strip(), 16)
+                    except ValueError:
+                        self._fail(HTTPClientError(599, 'bad chunk size'))
+                        return
+                    self.remaining = size
+                    self.chunk_state = 'data' if size else 'trailer'
+                elif self.chunk_state == 'data':
+                    if not self._on_chunk(data):
+                        return
+                    self.remaining -= len(data)
+                    if not self.remaining:
+                        self.chunk_state = 'end'
+                elif self.chunk_state == 'end':
+                    self.chunk_state = 'size'
+                elif not data.strip():
+                    self._finish()
+                    return
+
+            if self.chunk_state == 'data':
+                future = self.stream.read_bytes(
+                    min(self.remaining, self.READ_CHUNK_SIZE), partial=True,
+                )
+            else:
+                future = self.stream.read_until(
+                    b'\r\n', max_bytes=self.MAX_CHUNK_LINE,
+                )
+            if not future.done:
+                future.add_done_callback(self._read_chunked)
+                return
+
+    def _cancel_timeouts(self):
+        for timeout in (self._timeout, self._connect_timeout):
+            if timeout is not None:
+                self.io_loop.remove_timeout(timeout)
+        self._timeout = self._connect_timeout = None
+
+    def _finish(self):
+        self.finished = True
+        self._cancel_timeouts()
+        if self.keep_alive and not self.stream.closed():
+            self.client._release(self.pool, self.stream)
+        else:
+            self.stream.close()
+        self.pool.active -= 1
+        self.client._process_queue(self.pool)
+
+        body = ''.join(self.chunks)
+        self.future.set_result(HTTPResponse(
+            self.request, self.code, self.reason, self.headers, body,
+        ))
+
+    def _fail(self, error):
+        if self.finished:
+            return
+        self.finished = True
+        self._cancel_timeouts()
+        if self.stream is not None:
+            self.stream.close()
+        if self.started:
+            self.pool.active -= 1
+            self.client._process_queue(self.pool)
+
+        self.future.set_exception(error)
+
+
+class AsyncHTTPClient(object):
+    MAX_CONNECTIONS_PER_HOST = 10
+    MAX_QUEUE_SIZE = 1000
+    CONNECT_TIMEOUT = 20
+    REQUEST_TIMEOUT = 20
+    IDLE_TIMEOUT = 30
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 100 * 1024 * 1024
+
+    _resolver = None
+
+    def __init__(self, io_loop=None, max_connections_per_host=None,
+                 max_queue_size=None, max_header_size=None,
+                 max_body_size=None):
+        self.io_loop = io_loop or IOLoop.instance()
+        self.max_connections_per_host = (max_connections_per_host or
+                                         self.MAX_CONNECTIONS_PER_HOST)
+        self.max_queue_size = max_queue_size or self.MAX_QUEUE_SIZE
+        self.max_header_size = max_header_size or self.MAX_HEADER_SIZE
+        self.max_body_size = max_body_size or self.MAX_BODY_SIZE
+
+        # (host, port) -> _HostPool
+        self._pools = {}
+        self._queued = 0
+
+    def fetch(self, url, method='GET', headers=None, body=None, timeout=None,
+              connect_timeout=None, streaming_callback=None):
+        request = HTTPRequest(
+            url, method, headers, body,
+            connect_timeout=connect_timeout or self.CONNECT_TIMEOUT,
+            request_timeout=timeout or self.REQUEST_TIMEOUT,
+            streaming_callback=streaming_callback,
+        )
+        future = Future()
+
+        key = (request.host, request.port)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = _HostPool()
+
+        if (pool.active >= self.max_connections_per_host and
+                self._queued >= self.max_queue_size):
+            future.set_exception(HTTPClientError(599, 'too many requests'))
+            return future
+
+        connection = _HTTPConnection(self, pool, request, future)
+        if pool.active < self.max_connections_per_host:
+            connection.start()
+        else:
+            pool.waiting.append(connection)
+            self._queued += 1
+        return future
+
+    def resolve(self, host, port):
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+        except (socket.error, TypeError):
+            pass
+        else:
+            future = Future()
+            future.set_result((socket.AF_INET, (host, port)))
+            return future
+
+        if AsyncHTTPClient._resolver is None:
+            AsyncHTTPClient._resolver = ThreadPoolExecutor(2)
+        return self.io_loop.run_in_executor(
+            AsyncHTTPClient._resolver, _resolve, host, port,
+        )
+
+    def close(self):
+        for pool in self._pools.values():
+            while pool.idle:
+                stream = self._pop_idle(pool)
+                if stream is not None:
+                    stream.close()
+
+    def _process_queue(self, pool):
+        while pool.waiting and pool.active < self.max_connections_per_host:
+            connection = pool.waiting.popleft()
+            self._queued -= 1
+            connection.start()
+
+    def _release(self, pool, stream):
+        pool.idle.append(stream)
+        pool.idle_timeouts[stream] = self.io_loop.call_later(
+            self.IDLE_TIMEOUT, stream.close,
+        )
+        stream.set_close_callback(
+            functools.partial(self._discard_idle, pool, stream)
+        )
+
+    def _discard_idle(self, pool, stream):
+        try:
+            pool.idle.remove(stream)
+        except ValueError:
+            pass
+        timeout = pool.idle_timeouts.pop(stream, None)
+        if timeout is not None:
+            self.io_loop.remove_timeout(timeout)
+
+    def _pop_idle(self, pool):
+        while pool.idle:
+            # the most recently used connection is the least likely to
+            # have been closed by the server
+            stream = pool.idle.pop()
+            self.io_loop.remove_timeout(pool.idle_timeouts.pop(stream))
+            stream.set_close_callback(None)
+            if not stream.closed():
+                return stream
+        return None
+
+
+def _resolve(host, port):
+    family, _, _, _, address = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)[0]
+    return family, address
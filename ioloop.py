@@ -1,9 +1,162 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import fcntl
+import heapq
+import errno
 import select
 import functools
-import collections
+import itertools
+import threading
+
+
+class _Timeout(object):
+    __slots__ = ('deadline', 'callback', 'sequence')
+
+    _sequence = itertools.count()
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        # keeps timers with equal deadlines in scheduling order
+        self.sequence = next(self._sequence)
+
+    def __lt__(self, other):
+        return ((self.deadline, self.sequence) <
+                (other.deadline, other.sequence))
+
+    def __le__(self, other):
+        return ((self.deadline, self.sequence) <=
+                (other.deadline, other.sequence))
+
+
+class Waker(object):
+    def __init__(self):
+        self.reader, self.writer = os.pipe()
+        for fd in (self.reader, self.writer):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+    def fileno(self):
+        return self.reader
+
+    def wake(self):
+        try:
+            os.write(self.writer, b'x')
+        except (IOError, OSError):
+            # a full pipe already guarantees a wake up
+            pass
+
+    def consume(self):
+        try:
+            while os.read(self.reader, 4096):
+                pass
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        for fd in (self.reader, self.writer):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class EPollPoller(object):
+    # edge-triggered, a ready fd is reported once and its handler reads or
+    # writes until EAGAIN, no epoll_ctl call is needed to switch between
+    # reading and writing. the peer's FIN is asked for as well, it may
+    # come with the last data and raise no edge of its own
+    EDGE = 1 << 31
+
+    def __init__(self, edge_triggered=False):
+        self.edge_triggered = edge_triggered
+        self._flags = self.EDGE | IOLoop.PEER_CLOSED if edge_triggered else 0
+        self._epoll = select.epoll()
+        self.poll = self._epoll.poll
+
+    def register(self, fd, events):
+        self._epoll.register(fd, events | self._flags)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events | self._flags)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def close(self):
+        self._epoll.close()
+
+
+class PollPoller(object):
+    # the POLL* bits have the same values as IOLoop's EPOLL* ones
+    edge_triggered = False
+
+    def __init__(self):
+        self._poll = select.poll()
+        self.register = self._poll.register
+        self.modify = self._poll.modify
+        self.unregister = self._poll.unregister
+
+    def poll(self, timeout):
+        return self._poll.poll(timeout * 1000)
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+    # for platforms without epoll or poll and for tests
+    edge_triggered = False
+
+    def __init__(self):
+        self.read_fds = set()
+        self.write_fds = set()
+        self.error_fds = set()
+
+    def register(self, fd, events):
+        if events & IOLoop.READ:
+            self.read_fds.add(fd)
+        if events & IOLoop.WRITE:
+            self.write_fds.add(fd)
+        if events & IOLoop.ERROR:
+            self.error_fds.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self.read_fds.discard(fd)
+        self.write_fds.discard(fd)
+        self.error_fds.discard(fd)
+
+    def poll(self, timeout):
+        readable, writable, errors = select.select(
+            self.read_fds, self.write_fds, self.error_fds, timeout,
+        )
+        events = {}
+        for fd in readable:
+            events[fd] = IOLoop.READ
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | IOLoop.WRITE
+        for fd in errors:
+            events[fd] = events.get(fd, 0) | IOLoop.ERROR
+        return events.items()
+
+    def close(self):
+        pass
+
+
+def default_poller():
+    if hasattr(select, 'epoll'):
+        return EPollPoller(edge_triggered=True)
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
 
 
 class IOLoop(object):
@@ -11,19 +164,37 @@ class IOLoop(object):
     _EPOLLOUT = 0x004
     _EPOLLERR = 0x008
     _EPOLLHUP = 0x010
+    _EPOLLRDHUP = 0x2000
 
     READ = _EPOLLIN
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP
+    # only reported by an edge-triggered epoll
+    PEER_CLOSED = _EPOLLRDHUP
 
     PULL_TIMEOUT = 1
 
-    def __init__(self):
+    # compact the timer heap once this many cancelled timers pile up
+    # and they make up more than half of it
+    TIMEOUT_COMPACT_THRESHOLD = 512
+
+    def __init__(self, poller=None):
         self.handlers = {}
-        self.events = {}
-        self.epoll = select.epoll()
+        self.poller = poller or default_poller()
+        # streams drain their sockets themselves when this is set
+        self.edge_triggered = self.poller.edge_triggered
+        self._running = False
+
+        self._future_callbacks = []
+        self._callback_lock = threading.Lock()
+        self._timeouts = []
+        self._cancellations = 0
+
+        self._waker = Waker()
+        self.add_handler(self._waker, self._on_wake, self.READ)
 
-        self._future_callbacks = collections.deque()
+        # a metrics.LoopMetrics when instrumented
+        self.metrics = None
 
     @staticmethod
     def instance():
@@ -31,52 +202,310 @@ class IOLoop(object):
             IOLoop._instance = IOLoop()
         return IOLoop._instance
 
+    @staticmethod
+    def clear_instance():
+        if hasattr(IOLoop, '_instance'):
+            del IOLoop._instance
+
+    def install(self):
+        # makes this loop the one instance() returns, e.g. one built
+        # with a SelectPoller
+        IOLoop._instance = self
+
     def add_handler(self, fd_obj, handler, event):
         fd = fd_obj.fileno()
         self.handlers[fd] = (fd_obj, handler)
-        self.epoll.register(fd, event)
+        self.poller.register(fd, event)
 
     def update_handler(self, fd, event):
-        self.epoll.modify(fd, event)
+        self.poller.modify(fd, event)
 
     def remove_handler(self, fd):
         self.handlers.pop(fd, None)
         try:
-            self.epoll.unregister(fd)
+            self.poller.unregister(fd)
         except Exception as error:
-            print 'epoll unregister failed %r' % error
+            print 'poller unregister failed %r' % error
 
     def replace_handler(self, fd, handler):
         self.handlers[fd] = (self.handlers[fd][0], handler)
 
+    def time(self):
+        return time.time()
+
+    def call_at(self, deadline, callback, *args, **kwargs):
+        timeout = _Timeout(
+            deadline, functools.partial(callback, *args, **kwargs),
+        )
+        heapq.heappush(self._timeouts, timeout)
+        return timeout
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self.call_at(self.time() + delay, callback, *args, **kwargs)
+
+    def remove_timeout(self, timeout):
+        # lazy deletion, the heap entry is dropped when it reaches the top
+        # or when the heap is compacted
+        if timeout.callback is not None:
+            timeout.callback = None
+            self._cancellations += 1
+
+    def _pop_due_timeouts(self):
+        due_timeouts = []
+        if not self._timeouts:
+            return due_timeouts
+
+        now = self.time()
+        while self._timeouts:
+            timeout = self._timeouts[0]
+            if timeout.callback is None:
+                heapq.heappop(self._timeouts)
+                self._cancellations -= 1
+            elif timeout.deadline <= now:
+                due_timeouts.append(heapq.heappop(self._timeouts))
+            else:
+                break
+
+        if (self._cancellations > self.TIMEOUT_COMPACT_THRESHOLD and
+                self._cancellations > (len(self._timeouts) >> 1)):
+            self._timeouts = [
+                timeout for timeout in self._timeouts
+                if timeout.callback is not None
+            ]
+            heapq.heapify(self._timeouts)
+            self._cancellations = 0
+        return due_timeouts
+
+    def _poll_timeout(self):
+        if self._future_callbacks:
+            return 0
+        if self._timeouts:
+            delay = self._timeouts[0].deadline - self.time()
+            return max(0, min(delay, self.PULL_TIMEOUT))
+        return self.PULL_TIMEOUT
+
+    def pending_callbacks(self):
+        return len(self._future_callbacks)
+
+    def _run_callback(self, callback):
+        try:
+            callback()
+        except Exception as error:
+            print 'ioloop callback error: %r' % error
+
     def start(self):
+        self._running = True
+        busy_since = time.time()
         try:
-            while True:
-                for i in range(len(self._future_callbacks)):
-                    callback = self._future_callbacks.popleft()
-                    callback()
-
-                events = self.epoll.poll(self.PULL_TIMEOUT)
-                self.events.update(events)
-                while self.events:
-                    fd, event = self.events.popitem()
+            while self._running:
+                metrics = self.metrics
+                if self._future_callbacks:
+                    # callbacks added while these run wait for the next pass
+                    with self._callback_lock:
+                        callbacks = self._future_callbacks
+                        self._future_callbacks = []
+                    for callback in callbacks:
+                        try:
+                            callback()
+                        except Exception as error:
+                            print 'ioloop callback error: %r' % error
+
+                for timeout in self._pop_due_timeouts():
+                    if timeout.callback is not None:
+                        self._run_callback(timeout.callback)
+
+                if not self._running:
+                    break
+
+                if metrics is not None:
+                    metrics.busy.observe(time.time() - busy_since)
+                try:
+                    events = self.poller.poll(self._poll_timeout())
+                except (select.error, IOError, OSError) as error:
+                    if error.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if metrics is not None:
+                    busy_since = time.time()
+                    metrics.polls.value += 1
+                    metrics.events.value += len(events)
+                handlers = self.handlers
+                for fd, event in events:
+                    # an earlier handler in this batch may have removed it
+                    entry = handlers.get(fd)
+                    if entry is None:
+                        continue
                     try:
-                        fd_obj, handler = self.handlers[fd]
-                        handler(fd_obj, event)
+                        entry[1](entry[0], event)
                     except Exception as error:
-                        print 'ioloop callback error: %r' % error
-                        time.sleep(0.5)
+                        print 'ioloop handler error: %r' % error
         finally:
             for fd, _ in self.handlers.items():
                 self.remove_handler(fd)
-            self.epoll.close()
+            self.poller.close()
+            self._waker.close()
+
+    def stop(self):
+        self._running = False
+        self._waker.wake()
+
+    def _on_wake(self, waker, event):
+        waker.consume()
 
     def add_future_callback(self, callback, *args, **kwargs):
-        self._future_callbacks.append(
-            functools.partial(callback, *args, **kwargs)
-        )
+        if args or kwargs:
+            callback = functools.partial(callback, *args, **kwargs)
+        self._future_callbacks.append(callback)
+
+    def add_callback_from_thread(self, callback, *args, **kwargs):
+        # the lock keeps the append out of a batch the loop already took,
+        # the waker interrupts a blocking poll
+        with self._callback_lock:
+            self.add_future_callback(callback, *args, **kwargs)
+        self._waker.wake()
+
+    def add_callback_from_signal(self, callback, *args, **kwargs):
+        # a signal handler runs on the loop's own thread, possibly with the
+        # lock held by start(). the append needs no lock there, a batch
+        # taken just before it still runs it
+        self.add_future_callback(callback, *args, **kwargs)
+        self._waker.wake()
+
+    def run_in_executor(self, executor, fn, *args):
+        from concurrent import Future
+
+        future = Future()
+
+        def done(result, exc_info):
+            self.add_callback_from_thread(
+                _resolve_future, future, result, exc_info,
+            )
+
+        executor.execute(fn, args, {}, done)
+        return future
 
     def add_future(self, future, callback):
         future.add_done_callback(
             lambda future: self.add_future_callback(callback, future)
         )
+
+
+def _resolve_future(future, result, exc_info):
+    if exc_info is not None:
+        future.set_exc_info(exc_info)
+    else:
+        future.set_result(result)
+
+
+class PeriodicCallback(object):
+    def __init__(self, callback, callback_time, io_loop=None):
+        if callback_time <= 0:
+            raise ValueError('callback_time must be positive')
+        self.callback = callback
+        self.callback_time = callback_time
+        self.io_loop = io_loop or IOLoop.instance()
+        self._running = False
+        self._timeout = None
+        self._next_timeout = None
+
+    def start(self):
+        self._running = True
+        self._next_timeout = self.io_loop.time()
+        self._schedule_next()
+
+    def stop(self):
+        self._running = False
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def is_running(self):
+        return self._running
+
+    def _run(self):
+        if not self._running:
+            return
+        try:
+            self.callback()
+        except Exception as error:
+            print 'periodic callback error: %r' % error
+        self._schedule_next()
+
+    def _schedule_next(self):
+        if not self._running:
+            return
+        now = self.io_loop.time()
+        if self._next_timeout <= now:
+            # skip the beats missed while the loop was busy
+            missed = (now - self._next_timeout) // self.callback_time
+            self._next_timeout += (missed + 1) * self.callback_time
+        self._timeout = self.io_loop.call_at(self._next_timeout, self._run)
+
+
+class TimerWheel(object):
+    # coarse timers for many keys that are rearmed all the time, such as
+    # connection timeouts. a key sits in the set of the tick its deadline
+    # falls in, rearming moves it between sets and one periodic sweep
+    # expires whole ticks, so nothing goes through the timer heap. keys
+    # expire up to one resolution late, never early
+    def __init__(self, callback, resolution=1, io_loop=None):
+        self.callback = callback
+        self.resolution = resolution
+        self.io_loop = io_loop or IOLoop.instance()
+        self.buckets = {}
+        self.deadlines = {}
+        self._periodic = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, delay):
+        # the tick after the one the deadline falls in
+        tick = int((self.io_loop.time() + delay) / self.resolution) + 1
+        deadlines = self.deadlines
+        current = deadlines.get(key)
+        if current == tick:
+            return
+        if current is not None:
+            self._discard(key, current)
+        deadlines[key] = tick
+        bucket = self.buckets.get(tick)
+        if bucket is None:
+            bucket = self.buckets[tick] = set()
+        bucket.add(key)
+        if self._periodic is None:
+            self._periodic = PeriodicCallback(
+                self._sweep, self.resolution, self.io_loop,
+            )
+            self._periodic.start()
+
+    def cancel(self, key):
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            self._discard(key, tick)
+
+    def _discard(self, key, tick):
+        bucket = self.buckets[tick]
+        bucket.discard(key)
+        if not bucket:
+            del self.buckets[tick]
+
+    def _sweep(self):
+        now = self.io_loop.time() / self.resolution
+        for tick in sorted(tick for tick in self.buckets if tick <= now):
+            bucket = self.buckets.pop(tick, None)
+            if bucket is None:
+                continue
+            for key in bucket:
+                del self.deadlines[key]
+            for key in bucket:
+                if key in self.deadlines:
+                    # rescheduled by an earlier callback
+                    continue
+                try:
+                    self.callback(key)
+                except Exception as error:
+                    print 'timer wheel callback error: %r' % error
+        if not self.deadlines:
+            self._periodic.stop()
+            self._periodic = None
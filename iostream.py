@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+import collections
+
+from ioloop import IOLoop
+from concurrent import Future
+
+
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+def _load_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    # python 2 has no os.sendfile, libc's is called through ctypes
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        _sendfile = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (ImportError, OSError, AttributeError):
+        return None
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = _sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+
+sendfile = _load_sendfile()
+
+
+class StreamClosedError(IOError):
+    pass
+
+
+class StreamBufferFullError(IOError):
+    pass
+
+
+class UnsatisfiableReadError(IOError):
+    pass
+
+
+class FileSegment(object):
+    # count bytes of an open file from offset, queued like a buffer and
+    # sent by the kernel without passing through user space
+    __slots__ = ('fd', 'offset', 'count')
+
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+
+class IOStream(object):
+    READ_CHUNK_SIZE = 64 * 1024
+    MAX_BUFFER_SIZE = 100 * 1024 * 1024
+
+    # buffers handed to one sendmsg call
+    IOV_MAX = 64
+    # without sendmsg, buffers smaller than this are joined into one send
+    # while larger ones are sent from a memoryview without copying
+    COALESCE_SIZE = 16 * 1024
+
+    def __init__(self, socket, io_loop=None, max_buffer_size=None,
+                 read_chunk_size=None):
+        self.socket = socket
+        self.socket.setblocking(0)
+        self.fd = socket.fileno()
+        self.io_loop = io_loop or IOLoop.instance()
+        self.max_buffer_size = max_buffer_size or self.MAX_BUFFER_SIZE
+        self.read_chunk_size = read_chunk_size or self.READ_CHUNK_SIZE
+
+        # one growable buffer, consumed data is skipped by offset and only
+        # compacted once it makes up half of the buffer
+        self._read_buffer = bytearray()
+        self._read_buffer_pos = 0
+        self._read_scan_pos = 0
+        self._read_future = None
+        self._read_delimiter = None
+        self._read_max_bytes = None
+        self._read_bytes = None
+        self._read_partial = False
+
+        self._connect_future = None
+
+        self._write_queue = collections.deque()
+        self._write_offset = 0
+        self._sendmsg = getattr(self.socket, 'sendmsg', None)
+        self._write_futures = collections.deque()
+        self._total_bytes_queued = 0
+        self._total_bytes_written = 0
+
+        # edge-triggered loops report readiness once, until the socket is
+        # read up to EAGAIN it is taken to still have data waiting
+        self._edge = self.io_loop.edge_triggered
+        self._readable = self._edge
+        # the peer has shut down its side, reads go on until the EOF
+        self._peer_closed = False
+
+        self._state = None
+        self._closed = False
+        self._close_callback = None
+        self.error = None
+
+    def fileno(self):
+        return self.fd
+
+    def closed(self):
+        return self._closed
+
+    def reading(self):
+        return self._read_future is not None
+
+    def writing(self):
+        return bool(self._write_queue)
+
+    @property
+    def read_buffer_size(self):
+        return len(self._read_buffer) - self._read_buffer_pos
+
+    @property
+    def write_buffer_size(self):
+        return self._total_bytes_queued - self._total_bytes_written
+
+    @property
+    def bytes_written(self):
+        return self._total_bytes_written
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def connect(self, address):
+        future = self._connect_future = Future()
+        try:
+            self.socket.connect(address)
+        except socket.error as error:
+            if error.args[0] not in (errno.EINPROGRESS,) + _ERRNO_WOULDBLOCK:
+                self.close(error)
+                return future
+        self._update_state()
+        return future
+
+    def read_until(self, delimiter, max_bytes=None):
+        future = self._start_read()
+        self._read_delimiter = delimiter
+        self._read_max_bytes = max_bytes
+        self._read_scan_pos = self._read_buffer_pos
+        self._try_read_from_buffer()
+        self._resume_read()
+        self._update_state()
+        return future
+
+    def read_bytes(self, num_bytes, partial=False):
+        future = self._start_read()
+        self._read_bytes = num_bytes
+        self._read_partial = partial
+        self._try_read_from_buffer()
+        self._resume_read()
+        self._update_state()
+        return future
+
+    def write(self, data):
+        # data is one buffer or a list of buffers written back to back,
+        # FileSegments may take the place of any of them
+        future = Future()
+        if self._closed:
+            future.set_exception(StreamClosedError('stream is closed'))
+            return future
+
+        if isinstance(data, (list, tuple)):
+            for buf in data:
+                if buf:
+                    self._write_queue.append(buf)
+                    self._total_bytes_queued += len(buf)
+        elif data:
+            self._write_queue.append(data)
+            self._total_bytes_queued += len(data)
+        self._write_futures.append((self._total_bytes_queued, future))
+        if self._connect_future is None:
+            self._handle_write()
+        self._update_state()
+        return future
+
+    def close(self, error=None):
+        if self._closed:
+            return
+        self._closed = True
+        self.error = error
+
+        if self._state is not None:
+            self.io_loop.remove_handler(self.fd)
+            self._state = None
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+        closed_error = error or StreamClosedError('stream is closed')
+        if self._connect_future is not None:
+            future, self._connect_future = self._connect_future, None
+            future.set_exception(closed_error)
+        if self._read_future is not None:
+            future, self._read_future = self._read_future, None
+            future.set_exception(closed_error)
+        while self._write_futures:
+            _, future = self._write_futures.popleft()
+            future.set_exception(closed_error)
+        self._write_queue.clear()
+
+        if self._close_callback is not None:
+            callback, self._close_callback = self._close_callback, None
+            callback()
+
+    def _start_read(self):
+        if self._read_future is not None:
+            raise RuntimeError('already reading')
+        future = Future()
+        if self._closed:
+            future.set_exception(self.error or
+                         StreamClosedError('stream is closed'))
+            return future
+        self._read_future = future
+        return future
+
+    def _handle_events(self, fd_obj, event):
+        if self._closed:
+            return
+        try:
+            self._dispatch_events(event)
+        except Exception as error:
+            # a failing callback takes down its own stream, not the loop
+            print 'iostream handler error: %r' % error
+            self.close(error)
+
+    def _dispatch_events(self, event):
+        if self._connect_future is not None:
+            self._handle_connect()
+            if self._closed:
+                return
+            # edge-triggered, this event is all there will be for the
+            # reads and writes queued while connecting
+            if self.writing():
+                self._handle_write()
+            self._resume_read()
+            self._update_state()
+            return
+        if event & IOLoop.READ:
+            self._readable = self._edge
+            if event & IOLoop.PEER_CLOSED:
+                self._peer_closed = True
+            # edge-triggered, the data waits in the socket for a reader
+            if not self._edge or self.reading():
+                self._handle_read()
+        if self._closed:
+            return
+        if event & IOLoop.WRITE:
+            self._handle_write()
+        if self._closed:
+            return
+        if event & IOLoop.ERROR and not event & IOLoop.READ:
+            self.close()
+            return
+        self._update_state()
+
+    def _update_state(self):
+        if self._closed:
+            return
+        if self._edge:
+            # registered once for everything, never modified
+            if self._state is None:
+                self._state = IOLoop.READ | IOLoop.WRITE | IOLoop.ERROR
+                self.io_loop.add_handler(self.socket, self._handle_events,
+                                         self._state)
+            return
+        state = IOLoop.ERROR
+        if self._connect_future is not None:
+            state |= IOLoop.WRITE
+        elif self.reading() and self.read_buffer_size < self.max_buffer_size:
+            state |= IOLoop.READ
+        if self.writing():
+            state |= IOLoop.WRITE
+
+        if self._state is None:
+            self.io_loop.add_handler(self.socket, self._handle_events, state)
+        elif state != self._state:
+            self.io_loop.update_handler(self.fd, state)
+        self._state = state
+
+    def _handle_connect(self):
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.close(socket.error(err, os.strerror(err)))
+            return
+        future, self._connect_future = self._connect_future, None
+        future.set_result(self)
+
+    def _handle_read(self):
+        # one recv when level-triggered. edge-triggered, recv until the
+        # socket is drained or the pending read is satisfied, a short
+        # chunk means the socket was drained and the next data raises a
+        # new event, unless the peer has closed and only the EOF is left
+        while True:
+            try:
+                chunk = self.socket.recv(self.read_chunk_size)
+            except socket.error as error:
+                if error.args[0] in _ERRNO_WOULDBLOCK:
+                    self._readable = False
+                    return
+                self.close(error)
+                return
+            if not chunk:
+                self.close()
+                return
+            if len(chunk) < self.read_chunk_size and not self._peer_closed:
+                self._readable = False
+
+            self._read_buffer += chunk
+            if self.read_buffer_size > self.max_buffer_size:
+                self.close(StreamBufferFullError(
+                    'reached maximum read buffer'
+                ))
+                return
+            self._try_read_from_buffer()
+            if not self._readable or self._read_future is None:
+                return
+
+    def _resume_read(self):
+        # edge-triggered, data already waiting raises no new event
+        if (self._readable and self._read_future is not None and
+                self._connect_future is None):
+            self._handle_read()
+
+    def _find_read_size(self):
+        if self._read_bytes is not None:
+            available = self.read_buffer_size
+            if available >= self._read_bytes:
+                return self._read_bytes
+            if self._read_partial and available:
+                return available
+            return None
+
+        delimiter = self._read_delimiter
+        start = max(self._read_buffer_pos, self._read_scan_pos)
+        index = self._read_buffer.find(delimiter, start)
+        if index != -1:
+            return index + len(delimiter) - self._read_buffer_pos
+
+        # a delimiter split between two reads starts in the tail
+        self._read_scan_pos = max(
+            self._read_buffer_pos,
+            len(self._read_buffer) - len(delimiter) + 1,
+        )
+        if (self._read_max_bytes is not None and
+                self.read_buffer_size > self._read_max_bytes):
+            self.close(UnsatisfiableReadError(
+                'delimiter %r not found within %d bytes' % (
+                    delimiter, self._read_max_bytes)
+            ))
+        return None
+
+    def _try_read_from_buffer(self):
+        if self._read_future is None:
+            return
+        size = self._find_read_size()
+        if size is None or self._read_future is None:
+            return
+        if (self._read_delimiter is not None and
+                self._read_max_bytes is not None and
+                size > self._read_max_bytes):
+            self.close(UnsatisfiableReadError(
+                'delimiter %r not found within %d bytes' % (
+                    self._read_delimiter, self._read_max_bytes)
+            ))
+            return
+
+        data = self._consume(size)
+        future, self._read_future = self._read_future, None
+        self._read_delimiter = None
+        self._read_max_bytes = None
+        self._read_bytes = None
+        self._read_partial = False
+        future.set_result(data)
+
+    def _consume(self, size):
+        pos = self._read_buffer_pos
+        data = bytes(self._read_buffer[pos:pos + size])
+        pos += size
+        if pos == len(self._read_buffer):
+            del self._read_buffer[:]
+            pos = 0
+        elif pos > (len(self._read_buffer) >> 1):
+            del self._read_buffer[:pos]
+            pos = 0
+        self._read_buffer_pos = pos
+        self._read_scan_pos = pos
+        return data
+
+    def _next_buffers(self):
+        queue = self._write_queue
+        head = queue[0]
+        if self._write_offset:
+            head = memoryview(head)[self._write_offset:]
+
+        if self._sendmsg is not None:
+            buffers = [head]
+            for i in range(1, min(len(queue), self.IOV_MAX)):
+                if isinstance(queue[i], FileSegment):
+                    break
+                buffers.append(queue[i])
+            return buffers
+
+        if len(head) >= self.COALESCE_SIZE or len(queue) == 1:
+            return [head]
+        if self._write_offset:
+            head = head.tobytes()
+        buffers = [head]
+        size = len(head)
+        for i in range(1, len(queue)):
+            buf = queue[i]
+            if (isinstance(buf, FileSegment) or
+                    size + len(buf) > self.COALESCE_SIZE):
+                break
+            buffers.append(buf)
+            size += len(buf)
+        return buffers
+
+    def _advance_write(self, sent):
+        self._total_bytes_written += sent
+        queue = self._write_queue
+        while sent:
+            remaining = len(queue[0]) - self._write_offset
+            if sent < remaining:
+                self._write_offset += sent
+                return
+            sent -= remaining
+            queue.popleft()
+            self._write_offset = 0
+
+    def _send_buffers(self, buffers):
+        if self._sendmsg is not None:
+            return self.socket.sendmsg(buffers)
+        if len(buffers) == 1:
+            return self.socket.send(buffers[0])
+        return self.socket.send(b''.join(buffers))
+
+    def _send_file(self, segment):
+        offset = segment.offset + self._write_offset
+        count = segment.count - self._write_offset
+        if sendfile is not None:
+            return sendfile(self.fd, segment.fd, offset, count)
+        os.lseek(segment.fd, offset, os.SEEK_SET)
+        data = os.read(segment.fd, min(count, self.read_chunk_size))
+        if not data:
+            return 0
+        return self.socket.send(data)
+
+    def _handle_write(self):
+        while self._write_queue:
+            head = self._write_queue[0]
+            try:
+                if isinstance(head, FileSegment):
+                    size = len(head) - self._write_offset
+                    sent = self._send_file(head)
+                    if not sent:
+                        self.close(IOError(
+                            'file ended %d bytes short' % size
+                        ))
+                        return
+                else:
+                    buffers = self._next_buffers()
+                    size = sum(len(buf) for buf in buffers)
+                    sent = self._send_buffers(buffers)
+            except (socket.error, OSError) as error:
+                if error.args[0] in _ERRNO_WOULDBLOCK:
+                    break
+                self.close(error)
+                return
+
+            self._advance_write(sent)
+            if sent < size:
+                break
+
+        futures = self._write_futures
+        while futures and futures[0][0] <= self._total_bytes_written:
+            _, future = futures.popleft()
+            future.set_result(None)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    # read when the registry is rendered, so nothing is paid per event
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def snapshot(self):
+        return self.fn()
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last slot counts values above every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class Family(object):
+    # one metric name, a child per distinct tuple of label values
+    def __init__(self, kind, name, help, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Registry(object):
+    # Application(urls, metrics=Registry()) instruments routes, and the
+    # server and its IOLoop once run_server picks the registry up
+    def __init__(self):
+        self.families = {}
+
+    def counter(self, name, help, labelnames=()):
+        return self._register('counter', name, help, labelnames, Counter)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        buckets = tuple(buckets)
+        return self._register('histogram', name, help, labelnames,
+                              lambda: Histogram(buckets))
+
+    def gauge(self, name, help, fn):
+        family = self._register('gauge', name, help, (), None)
+        family.children[()] = Gauge(fn)
+        return family
+
+    def _register(self, kind, name, help, labelnames, factory):
+        # without labels the metric itself is returned, not its family
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(
+                kind, name, help, tuple(labelnames), factory,
+            )
+        elif family.kind != kind:
+            raise ValueError('%s is already a %s' % (name, family.kind))
+        if labelnames or factory is None:
+            return family
+        return family.labels()
+
+    def snapshot(self):
+        # {name: value} for unlabelled metrics, {name: {labels: value}}
+        # otherwise, histograms as a dict of buckets, sum and count
+        snapshot = {}
+        for name, family in self.families.items():
+            values = dict(
+                (labels, child.snapshot())
+                for labels, child in family.children.items()
+            )
+            snapshot[name] = values.get(()) if not family.labelnames \
+                else values
+        return snapshot
+
+    def render(self):
+        # prometheus text exposition format
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.append('# HELP %s %s' % (name, family.help))
+            lines.append('# TYPE %s %s' % (name, family.kind))
+            for labels, child in sorted(family.children.items()):
+                pairs = [
+                    '%s="%s"' % (label, _escape(value))
+                    for label, value in zip(family.labelnames, labels)
+                ]
+                value = child.snapshot()
+                if family.kind != 'histogram':
+                    lines.append('%s%s %s' % (
+                        name, '{%s}' % ','.join(pairs) if pairs else '',
+                        _format_value(value)))
+                    continue
+                for bound, count in value['buckets']:
+                    lines.append('%s_bucket{%s} %d' % (
+                        name, ','.join(pairs + ['le="%s"' % bound]), count))
+                suffix = '{%s}' % ','.join(pairs) if pairs else ''
+                lines.append('%s_sum%s %s' % (
+                    name, suffix, _format_value(value['sum'])))
+                lines.append('%s_count%s %d' % (
+                    name, suffix, value['count']))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class LoopMetrics(object):
+    # assigned to IOLoop.metrics, busy is the time spent between two polls.
+    # events per poll is events / polls, a histogram per iteration would
+    # cost more than the rest of the loop bookkeeping
+    def __init__(self, registry, io_loop):
+        self.busy = registry.histogram(
+            'zigmo_ioloop_busy_seconds',
+            'Time the IOLoop spends running handlers between two polls',
+        )
+        self.polls = registry.counter(
+            'zigmo_ioloop_polls_total', 'Polls made by the IOLoop',
+        )
+        self.events = registry.counter(
+            'zigmo_ioloop_events_total', 'Events returned by all polls',
+        )
+        registry.gauge(
+            'zigmo_ioloop_callbacks', 'Callbacks waiting to run',
+            io_loop.pending_callbacks,
+        )
+
+
+class MetricsHandler(object):
+    # opt-in endpoint, ('/metrics', MetricsHandler(registry))
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def get(self, response, **kwargs):
+        response.set_header('Content-Type', self.CONTENT_TYPE)
+        return self.registry.render()
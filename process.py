@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import errno
+import signal
+import traceback
+
+
+class Supervisor(object):
+    CHECK_INTERVAL = 0.2
+    GRACEFUL_TIMEOUT = 30
+    RESPAWN_DELAY = 1
+
+    def __init__(self, target, workers):
+        self.target = target
+        self.workers = workers
+
+        # pid -> spawn time of the serving workers
+        self.children = {}
+        # pid -> SIGKILL deadline of workers asked to stop
+        self.retiring = {}
+
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                # the supervisor decides when workers stop or reload
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.target()
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        self.children[pid] = time.time()
+        return pid
+
+    def retire(self, pids):
+        deadline = time.time() + self.GRACEFUL_TIMEOUT
+        for pid in pids:
+            self.children.pop(pid, None)
+            self.retiring[pid] = deadline
+            self.kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as error:
+            if error.errno != errno.ESRCH:
+                raise
+
+    def reload(self):
+        # new workers start accepting before the old ones drain
+        old_workers = list(self.children)
+        for i in range(self.workers):
+            self.spawn()
+        self.retire(old_workers)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+
+            if self.retiring.pop(pid, None) is not None:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+
+            print 'worker %d exited with status %d, restarting' % (
+                pid, status)
+            if time.time() - started < self.RESPAWN_DELAY:
+                time.sleep(self.RESPAWN_DELAY)
+            self.spawn()
+
+    def kill_overdue(self):
+        now = time.time()
+        for pid, deadline in self.retiring.items():
+            if now > deadline:
+                self.kill(pid, signal.SIGKILL)
+                self.retiring[pid] = float('inf')
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def start(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+
+        for i in range(self.workers):
+            self.spawn()
+
+        while self.children or self.retiring:
+            if self.stopping and self.children:
+                self.retire(list(self.children))
+            elif self.reloading:
+                self.reloading = False
+                self.reload()
+
+            self.reap()
+            self.kill_overdue()
+            time.sleep(self.CHECK_INTERVAL)
+
+
+def fork_workers(target, workers):
+    Supervisor(target, workers).start()
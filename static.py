@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import stat
+import time
+import urllib
+import binascii
+import mimetypes
+import email.utils
+
+from wsgi_server import FileWrapper
+from zigmo import BaseHandler, HandlerNotFound
+from util import SegmentedLRUCache
+
+
+class _OpenFile(object):
+    # a descriptor shared by every response sending the file, it's closed
+    # once it has left the cache and the last response is done with it
+    def __init__(self, path, fd, st):
+        self.path = path
+        self.fd = fd
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self.identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        self.etag = '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.content_type = (mimetypes.guess_type(path)[0] or
+                             'application/octet-stream')
+        self.checked = time.time()
+        self.refs = 0
+        self.evicted = False
+
+    def matches(self, st):
+        return self.identity == (
+            st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+        )
+
+    def acquire(self):
+        self.refs += 1
+        return self
+
+    def evict(self):
+        self.evicted = True
+        self._maybe_close()
+
+    def _maybe_close(self):
+        if self.evicted and self.refs <= 0 and self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # the file object handed to FileWrapper
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset):
+        os.lseek(self.fd, offset, os.SEEK_SET)
+
+    def read(self, size):
+        return os.read(self.fd, size)
+
+    def close(self):
+        self.refs -= 1
+        self._maybe_close()
+
+
+class StaticFileHandler(BaseHandler):
+    # mounted with a path parameter, e.g.
+    # ('/static/<path:path>', StaticFileHandler('/var/www/static'))
+    CACHE_SIZE = 256
+    # seconds a cached file is trusted before it's stat'ed again
+    REVALIDATE_INTERVAL = 1
+    # requests asking for more ranges get the whole file
+    MAX_RANGES = 16
+    RANGE_PATTERN = re.compile(r'^(\d*)-(\d*)$')
+
+    def __init__(self, root, cache_size=None, revalidate_interval=None,
+                 max_age=None):
+        if revalidate_interval is None:
+            revalidate_interval = self.REVALIDATE_INTERVAL
+        self.root = os.path.realpath(root)
+        self.revalidate_interval = revalidate_interval
+        self.max_age = max_age
+        self.files = SegmentedLRUCache(
+            cache_size or self.CACHE_SIZE,
+            on_evict=lambda path, opened: opened.evict(),
+        )
+
+    def get(self, request, response, path):
+        opened = self.lookup(path)
+        if opened is None:
+            raise HandlerNotFound()
+
+        response.set_header('Content-Type', opened.content_type)
+        response.set_header('Last-Modified', opened.last_modified)
+        response.set_header('ETag', opened.etag)
+        response.set_header('Accept-Ranges', 'bytes')
+        if self.max_age is not None:
+            response.set_header('Cache-Control', 'max-age=%d' % self.max_age)
+
+        headers = request.headers
+        if self.not_modified(headers, opened):
+            response.set_response_code(304)
+            return None
+
+        ranges = None
+        if 'RANGE' in headers and self.if_range(headers, opened):
+            ranges = self.parse_range(headers['RANGE'], opened.size)
+        if ranges is None or len(ranges) > self.MAX_RANGES:
+            response.set_header('Content-Length', opened.size)
+            # the cached size spares the server a stat of its own
+            return FileWrapper(opened.acquire(), ranges=[(0, opened.size)])
+
+        if not ranges:
+            response.set_response_code(416)
+            response.set_header('Content-Range', 'bytes */%d' % opened.size)
+            return None
+
+        response.set_response_code(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            response.set_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, end, opened.size))
+            response.set_header('Content-Length', end - start + 1)
+            return FileWrapper(opened.acquire(),
+                               ranges=[(start, end - start + 1)])
+
+        boundary = binascii.hexlify(os.urandom(12))
+        parts = []
+        for start, end in ranges:
+            parts.append(
+                '\r\n--%s\r\nContent-Type: %s\r\n'
+                'Content-Range: bytes %d-%d/%d\r\n\r\n' % (
+                    boundary, opened.content_type, start, end, opened.size)
+            )
+            parts.append((start, end - start + 1))
+        parts.append('\r\n--%s--\r\n' % boundary)
+        response.set_header('Content-Type',
+                            'multipart/byteranges; boundary=%s' % boundary)
+        response.set_header('Content-Length', sum(
+            len(part) if isinstance(part, str) else part[1]
+            for part in parts
+        ))
+        return FileWrapper(opened.acquire(), ranges=parts)
+
+    head = get
+
+    def lookup(self, path):
+        opened = self.files.get(path)
+        if opened is not None:
+            now = time.time()
+            if now - opened.checked < self.revalidate_interval:
+                return opened
+            try:
+                st = os.stat(opened.path)
+            except OSError:
+                st = None
+            if st is not None and opened.matches(st):
+                opened.checked = now
+                return opened
+            self.files.pop(path)
+            opened.evict()
+
+        opened = self.open(path)
+        if opened is not None:
+            self.files.set(path, opened)
+        return opened
+
+    def open(self, path):
+        path = urllib.unquote(path)
+        if '\0' in path:
+            # realpath() raises on a NUL byte
+            return None
+        full_path = os.path.realpath(os.path.join(self.root, path))
+        if not full_path.startswith(self.root + os.sep):
+            return None
+        try:
+            fd = os.open(full_path, os.O_RDONLY)
+        except OSError:
+            return None
+
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
+            return None
+        return _OpenFile(full_path, fd, st)
+
+    @staticmethod
+    def not_modified(headers, opened):
+        if 'IF-NONE-MATCH' in headers:
+            etags = [etag.strip() for etag in
+                     headers['IF-NONE-MATCH'].split(',')]
+            return ('*' in etags or opened.etag in etags or
+                    'W/' + opened.etag in etags)
+
+        since = email.utils.parsedate_tz(headers.get('IF-MODIFIED-SINCE', ''))
+        if since is None:
+            return False
+        return int(opened.mtime) <= email.utils.mktime_tz(since)
+
+    @staticmethod
+    def if_range(headers, opened):
+        validator = headers.get('IF-RANGE')
+        return validator is None or validator in (
+            opened.etag, opened.last_modified,
+        )
+
+    @classmethod
+    def parse_range(cls, header, size):
+        # None means the header is ignored and the whole file is sent,
+        # an empty list that none of the ranges can be satisfied
+        unit, _, specs = header.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+
+        ranges = []
+        for spec in specs.split(','):
+            spec = spec.replace(' ', '')
+            if not spec:
+                continue
+            match = cls.RANGE_PATTERN.match(spec)
+            if match is None:
+                return None
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                if last and int(last) < start:
+                    return None
+                if start >= size:
+                    continue
+                end = min(int(last), size - 1) if last else size - 1
+                ranges.append((start, end))
+            elif last:
+                if int(last) and size:
+                    ranges.append((max(0, size - int(last)), size - 1))
+            else:
+                return None
+
+        # overlapping and adjacent ranges are sent as one
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+            else:
+                merged.append((start, end))
+        return merged
@@ -58,3 +58,90 @@ def mk_gen():
     generator = type((lambda: (yield))())
     Generator.register(generator)
     return Generator
+
+
+class SegmentedLRUCache(object):
+    # new keys enter the probation segment and are only promoted to the
+    # protected segment on a second hit, so a stream of one-off keys can't
+    # push out the hot ones
+    PROTECTED_RATIO = 0.8
+
+    def __init__(self, capacity, protected_ratio=None, on_evict=None):
+        if capacity < 2:
+            raise ValueError('capacity must be at least 2')
+        if protected_ratio is None:
+            protected_ratio = self.PROTECTED_RATIO
+        self.capacity = capacity
+        self.protected_capacity = max(1, int(capacity * protected_ratio))
+        self.probation = _collections_abc.OrderedDict()
+        self.protected = _collections_abc.OrderedDict()
+        # called with (key, value) for entries dropped by eviction or clear
+        self.on_evict = on_evict
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def __contains__(self, key):
+        return key in self.protected or key in self.probation
+
+    def get(self, key, default=None):
+        protected = self.protected
+        if key in protected:
+            value = protected.pop(key)
+            protected[key] = value
+            self.hits += 1
+            return value
+
+        if key in self.probation:
+            value = self.probation.pop(key)
+            protected[key] = value
+            if len(protected) > self.protected_capacity:
+                demoted_key, demoted = protected.popitem(last=False)
+                self.probation[demoted_key] = demoted
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        if key in self.protected:
+            self.protected[key] = value
+            return
+
+        self.probation.pop(key, None)
+        self.probation[key] = value
+        while len(self) > self.capacity:
+            if self.probation:
+                evicted = self.probation.popitem(last=False)
+            else:
+                evicted = self.protected.popitem(last=False)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(*evicted)
+
+    def pop(self, key, default=None):
+        if key in self.protected:
+            return self.protected.pop(key)
+        return self.probation.pop(key, default)
+
+    def clear(self):
+        if self.on_evict is not None:
+            for segment in (self.probation, self.protected):
+                for key, value in segment.items():
+                    self.on_evict(key, value)
+        self.probation.clear()
+        self.protected.clear()
+
+    def stats(self):
+        return {
+            'size': len(self),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
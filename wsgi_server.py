@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
+import time
+import errno
+import signal
 import socket
 import logging
 import StringIO
+import functools
+import collections
 from datetime import datetime
 
-from ioloop import IOLoop
+from ioloop import IOLoop, TimerWheel
+from iostream import IOStream, FileSegment
+from concurrent import Future
+from accesslog import AccessLog
+from metrics import LoopMetrics
 
 
 EOL1 = b'\n\n'
@@ -24,34 +34,457 @@ access_logger = logging.getLogger('zigmo_access')
 access_logger.addHandler(stream_handler)
 access_logger.setLevel(logging.INFO)
 
+_FRAMING_HEADERS = ('connection', 'content-length', 'transfer-encoding')
+# responses that never carry a body or a Content-Length
+_BODILESS_STATUSES = ('1', '204', '304')
+
+# environ key of {environ key: [values]} for request headers sent more than
+# once, their environ value is the values joined by ','
+HEADER_LISTS = 'zigmo.header_lists'
+
+_environ_keys = {}
+_ENVIRON_KEYS_MAX = 1024
+
+
+def environ_key(header):
+    # 'Accept-Encoding' -> 'HTTP_ACCEPT_ENCODING'
+    key = _environ_keys.get(header)
+    if key is None:
+        key = header.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if len(_environ_keys) < _ENVIRON_KEYS_MAX:
+            _environ_keys[header] = key
+    return key
+
+
+class HTTPError(Exception):
+    def __init__(self, code, reason):
+        super(HTTPError, self).__init__(code, reason)
+        self.code = code
+        self.reason = reason
+
+    @property
+    def status(self):
+        return '%d %s' % (self.code, self.reason)
+
+
+class FileWrapper(object):
+    # wsgi.file_wrapper, a wrapped file with a fileno() is handed to
+    # sendfile by the server instead of being iterated. ranges are the
+    # (offset, length) parts of the file to send, a length of None runs to
+    # the end of the file and byte strings in between are sent as they are
+    def __init__(self, filelike, blksize=8192, ranges=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.ranges = ranges if ranges is not None else [(0, None)]
+
+    def fileno(self):
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def __iter__(self):
+        for part in self.ranges:
+            if isinstance(part, str):
+                yield part
+                continue
+
+            offset, length = part
+            while length is None or length > 0:
+                size = self.blksize
+                if length is not None:
+                    size = min(size, length)
+                # the file may be shared, so every read seeks first
+                self.filelike.seek(offset)
+                data = self.filelike.read(size)
+                if not data:
+                    break
+                offset += len(data)
+                if length is not None:
+                    length -= len(data)
+                yield data
+
+    def close(self):
+        close = getattr(self.filelike, 'close', None)
+        if close is not None:
+            close()
+
+
+class RequestParser(object):
+    HEADERS = 'headers'
+    BODY = 'body'
+    CHUNK_SIZE = 'chunk_size'
+    CHUNK_DATA = 'chunk_data'
+    CHUNK_END = 'chunk_end'
+    TRAILER = 'trailer'
+    DONE = 'done'
+
+    MAX_CHUNK_LINE = 1024
+
+    def __init__(self, max_header_size, max_body_size):
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.state = self.HEADERS
+        self.scan_offset = 0
+        self.request_data = None
+        self.body = []
+        self.body_size = 0
+        self.remaining = 0
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        requests = []
+        while getattr(self, '_parse_' + self.state)():
+            if self.state == self.DONE:
+                requests.append(self.finish())
+                self.reset()
+        return requests
+
+    def finish(self):
+        body = ''.join(self.body)
+        self.request_data['CONTENT_LENGTH'] = str(len(body))
+        self.request_data['wsgi.input'] = StringIO.StringIO(body)
+        return self.request_data
+
+    def _find_header_end(self):
+        buf = self.buffer
+        ends = [
+            index + len(eol)
+            for index, eol in ((buf.find(eol, self.scan_offset), eol)
+                               for eol in (EOL2, EOL1))
+            if index != -1
+        ]
+        return min(ends) if ends else -1
+
+    def _parse_headers(self):
+        buf = self.buffer
+        header_end = self._find_header_end()
+        if header_end == -1:
+            if len(buf) > self.max_header_size:
+                raise HTTPError(431, 'Request Header Fields Too Large')
+            # the next search only needs to cover the tail of a delimiter
+            # split between two reads
+            self.scan_offset = max(0, len(buf) - len(EOL2))
+            return False
+        if header_end > self.max_header_size:
+            raise HTTPError(431, 'Request Header Fields Too Large')
+
+        header_text = str(buf[:header_end])
+        del buf[:header_end]
+        self.request_data = self.parse_headers(header_text)
+        return self._start_body()
+
+    @classmethod
+    def parse_headers(cls, text):
+        lines = text.splitlines()
+        while lines and not lines[0]:
+            lines.pop(0)
+        try:
+            request_method, uri, request_version = lines[0].split()
+        except (IndexError, ValueError):
+            raise HTTPError(400, 'Bad Request')
+        if not request_version.startswith('HTTP/'):
+            raise HTTPError(400, 'Bad Request')
+
+        if '?' in uri:
+            path, query_string = uri.split('?', 1)
+        else:
+            path, query_string = uri, ''
+
+        request_data = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': request_method,
+            'REQUEST_URI': uri,
+            'SERVER_PROTOCOL': request_version,
+            'QUERY_STRING': query_string,
+        }
+
+        key = None
+        for line in lines[1:]:
+            if not line:
+                continue
+            if line[0] in ' \t' and key is not None:
+                # obsolete line folding
+                if key:
+                    request_data[key] += ' ' + line.strip()
+                    repeated = request_data.get(HEADER_LISTS)
+                    if repeated and key in repeated:
+                        repeated[key][-1] += ' ' + line.strip()
+                continue
+            if ':' not in line:
+                raise HTTPError(400, 'Bad Request')
+            name, value = line.split(':', 1)
+            name = name.strip()
+            if '_' in name:
+                # Transfer_Encoding would pass for Transfer-Encoding once
+                # mangled, while a proxy in front frames the request by
+                # the real one. dropped with its folded lines
+                key = ''
+                continue
+            key = environ_key(name)
+            value = value.strip()
+            if key in request_data:
+                repeated = request_data.setdefault(HEADER_LISTS, {})
+                repeated.setdefault(key, [request_data[key]]).append(value)
+                request_data[key] += ',' + value
+            else:
+                request_data[key] = value
+        return request_data
+
+    def _start_body(self):
+        request_data = self.request_data
+        encoding = request_data.get('HTTP_TRANSFER_ENCODING', '').lower()
+        if encoding:
+            if encoding.rsplit(',', 1)[-1].strip() != 'chunked':
+                raise HTTPError(400, 'Bad Request')
+            request_data.pop('CONTENT_LENGTH', None)
+            self.state = self.CHUNK_SIZE
+            return True
+
+        try:
+            length = int(request_data.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise HTTPError(400, 'Bad Request')
+        if length < 0:
+            raise HTTPError(400, 'Bad Request')
+        if length > self.max_body_size:
+            raise HTTPError(413, 'Request Entity Too Large')
+
+        self.remaining = length
+        self.state = self.BODY if length else self.DONE
+        return True
+
+    def _consume(self):
+        buf = self.buffer
+        size = min(len(buf), self.remaining)
+        if size:
+            self.body.append(str(buf[:size]))
+            del buf[:size]
+            self.remaining -= size
+        return not self.remaining
+
+    def _parse_body(self):
+        if not self._consume():
+            return False
+        self.state = self.DONE
+        return True
+
+    def _read_line(self):
+        buf = self.buffer
+        index = buf.find(b'\n')
+        if index == -1:
+            if len(buf) > self.MAX_CHUNK_LINE:
+                raise HTTPError(400, 'Bad Request')
+            return None
+        line = str(buf[:index]).strip()
+        del buf[:index + 1]
+        return line
+
+    def _parse_chunk_size(self):
+        line = self._read_line()
+        if line is None:
+            return False
+        try:
+            size = int(line.split(';', 1)[0], 16)
+        except ValueError:
+            raise HTTPError(400, 'Bad Request')
+        if size == 0:
+            self.state = self.TRAILER
+            return True
+
+        self.body_size += size
+        if self.body_size > self.max_body_size:
+            raise HTTPError(413, 'Request Entity Too Large')
+        self.remaining = size
+        self.state = self.CHUNK_DATA
+        return True
+
+    def _parse_chunk_data(self):
+        if not self._consume():
+            return False
+        self.state = self.CHUNK_END
+        return True
+
+    def _parse_chunk_end(self):
+        line = self._read_line()
+        if line is None:
+            return False
+        if line:
+            raise HTTPError(400, 'Bad Request')
+        self.state = self.CHUNK_SIZE
+        return True
+
+    def _parse_trailer(self):
+        while True:
+            line = self._read_line()
+            if line is None:
+                return False
+            if not line:
+                self.state = self.DONE
+                return True
+
+    def _parse_done(self):
+        return False
+
 
 class Connection(object):
-    def __init__(self, fd):
-        self.fd = fd
-        self.request_buffer = []
-        self.handled = False
-        self.response = b''
+    def __init__(self, stream, parser):
+        self.stream = stream
+        self.fd = stream.fileno()
+        self.parser = parser
+        self.requests = collections.deque()
+        self.keep_alive = False
+        self.requests_handled = 0
 
         self.headers = None
         self.status = None
+        self.content_length = None
+        self.chunked = False
+        self.last_write = None
         self.address = None
+        # stream bytes already added to the sent bytes counter
+        self.bytes_counted = 0
+        # what the armed timeout waits for, and the bytes written when a
+        # write timeout was armed
+        self.phase = None
+        self.write_mark = 0
+        # the Future of a response still waiting on its handler, and the
+        # chunk Future a streamed body is waiting on
+        self.parked = None
+        self.pending = None
+
+    def reset(self):
+        self.keep_alive = False
+        self.headers = None
+        self.status = None
+        self.content_length = None
+        self.chunked = False
+        self.last_write = None
+
+    @property
+    def idle(self):
+        return (self.stream.reading() and not self.requests and
+                self.parser is not None and not self.parser.buffer)
+
+    def read_phase(self):
+        parser = self.parser
+        if parser.state != parser.HEADERS:
+            return WSGIServer.BODY
+        if parser.buffer:
+            return WSGIServer.HEADERS
+        return WSGIServer.IDLE
+
+    def feed(self, data):
+        try:
+            self.requests.extend(self.parser.feed(data))
+        except HTTPError as error:
+            # answered after the requests already queued, then closed
+            self.requests.append(error)
+            self.parser = None
 
 
 class WSGIServer(object):
     ADDRESS_FAMILY = socket.AF_INET
     SOCKET_TYPE = socket.SOCK_STREAM
-    BACKLOG = 5
+    # bursts of new clients wait here, the kernel caps it at
+    # net.core.somaxconn
+    BACKLOG = 1024
 
     HEADER_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
     SERVER_NAME = 'zigmo/WSGIServer 0.3'
 
-    def __init__(self, server_address):
+    READ_CHUNK_SIZE = 64 * 1024
+    # streamed bodies pull their next chunk once the stream's write
+    # buffer drains below this
+    STREAM_HIGH_WATER = 64 * 1024
+    MAX_KEEPALIVE_REQUESTS = 100
+    MAX_HEADER_SIZE = 64 * 1024
+    MAX_BODY_SIZE = 10 * 1024 * 1024
+
+    # timeout phases. idle waits for the first byte of a request, headers
+    # for the rest of the header block since that byte, body for each
+    # next piece of the body, handling for an application still waiting
+    # on its handler and writing for each next sent byte. a timeout of 0
+    # turns its phase off
+    IDLE = 'idle'
+    HEADERS = 'headers'
+    BODY = 'body'
+    HANDLING = 'handling'
+    WRITING = 'writing'
+    IDLE_TIMEOUT = 60
+    HEADER_TIMEOUT = 30
+    BODY_TIMEOUT = 60
+    HANDLER_TIMEOUT = 60
+    WRITE_TIMEOUT = 60
+    TIMEOUT_RESOLUTION = 1
+
+    def __init__(self, server_address, max_keepalive_requests=None,
+                 max_header_size=None, max_body_size=None, access_log=None,
+                 metrics=None, idle_timeout=None, header_timeout=None,
+                 body_timeout=None, handler_timeout=None, write_timeout=None,
+                 max_connections=None):
+        if max_keepalive_requests is None:
+            max_keepalive_requests = self.MAX_KEEPALIVE_REQUESTS
+        if max_header_size is None:
+            max_header_size = self.MAX_HEADER_SIZE
+        if max_body_size is None:
+            max_body_size = self.MAX_BODY_SIZE
+        self.max_keepalive_requests = max_keepalive_requests
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.access_log = access_log or AccessLog(logger=access_logger)
+        self.timeouts = {
+            self.IDLE: self.IDLE_TIMEOUT,
+            self.HEADERS: self.HEADER_TIMEOUT,
+            self.BODY: self.BODY_TIMEOUT,
+            self.HANDLING: self.HANDLER_TIMEOUT,
+            self.WRITING: self.WRITE_TIMEOUT,
+        }
+        for phase, timeout in ((self.IDLE, idle_timeout),
+                               (self.HEADERS, header_timeout),
+                               (self.BODY, body_timeout),
+                               (self.HANDLING, handler_timeout),
+                               (self.WRITING, write_timeout)):
+            if timeout is not None:
+                self.timeouts[phase] = timeout
+        # accepting pauses at this many open connections
+        self.max_connections = max_connections
+
         self.ssocket = self.setup_server_socket(server_address)
         host, self.server_port = self.ssocket.getsockname()[:2]
         self.server_name = socket.getfqdn(host)
 
         self.ioloop = IOLoop.instance()
         self.conn_pool = {}
+        self.multiprocess = False
+        self.stopping = False
+        self.accepting = False
+        self.timer_wheel = TimerWheel(
+            self._on_timeout, self.TIMEOUT_RESOLUTION, self.ioloop,
+        )
+
+        # a metrics.Registry, also instruments the IOLoop
+        self.metrics = metrics
+        if metrics is not None:
+            self.ioloop.metrics = LoopMetrics(metrics, self.ioloop)
+            metrics.gauge('zigmo_connections', 'Open client connections',
+                          lambda: len(self.conn_pool))
+            self.bytes_received = metrics.counter(
+                'zigmo_received_bytes_total', 'Bytes read from clients',
+            )
+            self.bytes_sent = metrics.counter(
+                'zigmo_sent_bytes_total', 'Bytes written to clients',
+            )
+            self.timeouts_expired = metrics.counter(
+                'zigmo_timeouts_total', 'Connections closed by a timeout',
+                ('phase',),
+            )
 
     @classmethod
     def setup_server_socket(cls, server_address):
@@ -66,121 +499,410 @@ class WSGIServer(object):
         self.application = application
 
     def _accept(self, ssocket, event):
-        if event & IOLoop.ERROR:
-            self._close(ssocket)
-
-        connect, addr = ssocket.accept()
-        connect.setblocking(0)
-        ioloop = IOLoop.instance()
-        ioloop.add_handler(connect, self._receive, IOLoop.READ)
-
-        fd = connect.fileno()
-        connection = Connection(fd)
-        connection.address = addr
-        self.conn_pool[fd] = connection
-
-    def _receive(self, connect, event):
-        if event & IOLoop.ERROR:
-            self._close(connect)
-
-        fd = connect.fileno()
-        connection = self.conn_pool[fd]
-        fragment = connect.recv(1024)
-        connection.request_buffer.append(fragment)
-
-        last_fragment = ''.join(connection.request_buffer[:2])
-        if EOL2 in last_fragment:
-            ioloop = IOLoop.instance()
-            ioloop.update_handler(fd, IOLoop.WRITE)
-            ioloop.replace_handler(fd, self._send)
-
-    def _send(self, connect, event):
-        if event & IOLoop.ERROR:
-            self._close(connect)
-
-        fd = connect.fileno()
-        connection = self.conn_pool[fd]
-        if not connection.handled:
-            self.handle(connection)
+        # accept until EAGAIN, an edge-triggered loop reports the
+        # connections already queued only once
+        while True:
+            try:
+                connect, addr = ssocket.accept()
+            except socket.error as error:
+                if error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if error.args[0] == errno.ECONNABORTED:
+                    continue
+                raise
+
+            stream = IOStream(connect, self.ioloop,
+                              read_chunk_size=self.READ_CHUNK_SIZE)
+            parser = RequestParser(self.max_header_size, self.max_body_size)
+            connection = Connection(stream, parser)
+            connection.address = addr
+            self.conn_pool[connection.fd] = connection
+            stream.set_close_callback(
+                functools.partial(self._on_close, connection)
+            )
+            # the first read may run the application right away, it waits
+            # for the next loop iteration so nothing it does can cut this
+            # loop short before EAGAIN
+            self.ioloop.add_future_callback(self._read_request, connection)
+            if (self.max_connections is not None and
+                    len(self.conn_pool) >= self.max_connections):
+                # the rest wait in the listen backlog
+                self._pause_accepting()
+                return
+
+    def _pause_accepting(self):
+        if self.accepting:
+            self.accepting = False
+            self.ioloop.remove_handler(self.ssocket.fileno())
+
+    def _resume_accepting(self):
+        if not self.accepting and not self.stopping:
+            self.accepting = True
+            self.ioloop.add_handler(self.ssocket, self._accept,
+                                    IOLoop.READ | IOLoop.ERROR)
+
+    def _arm_timeout(self, connection, phase):
+        # the header timeout runs from the first byte and is not pushed
+        # back by the bytes that follow
+        if phase == connection.phase == self.HEADERS:
+            return
+        connection.phase = phase
+        timeout = self.timeouts[phase]
+        if not timeout:
+            self.timer_wheel.cancel(connection)
+            return
+        if phase == self.WRITING:
+            connection.write_mark = connection.stream.bytes_written
+        self.timer_wheel.schedule(connection, timeout)
+
+    def _on_timeout(self, connection):
+        stream = connection.stream
+        if stream.closed():
+            return
+        phase = connection.phase
+        if phase == self.WRITING:
+            # a body the application is slow to produce is not the
+            # client's fault, only a write that makes no progress is, or
+            # a write phase left with nothing to send or wait for
+            if stream.writing():
+                stalled = stream.bytes_written == connection.write_mark
+            else:
+                stalled = connection.pending is None
+            if stalled:
+                self._expire(connection, phase)
+                stream.close()
+            else:
+                connection.phase = None
+                self._arm_timeout(connection, phase)
+        elif phase == self.HANDLING:
+            self._expire(connection, phase)
+            # the handler is left to finish, its late response is dropped
+            connection.parked = None
+            connection.reset()
+            future = self._write_response(connection, self.handle_error(
+                connection, HTTPError(503, 'Service Unavailable'),
+            ))
+            future.add_done_callback(
+                functools.partial(self._on_write, connection)
+            )
+        elif phase == self.IDLE:
+            self._expire(connection, phase)
+            stream.close()
+        elif phase in (self.HEADERS, self.BODY):
+            self._expire(connection, phase)
+            # nothing more is read, the 408 goes out and the connection
+            # closes behind it
+            connection.parser = None
+            connection.requests.append(HTTPError(408, 'Request Timeout'))
+            self._respond(connection)
+
+    def _expire(self, connection, phase):
+        if self.metrics is not None:
+            self.timeouts_expired.labels(phase).inc()
+
+    def _read_request(self, connection):
+        self._arm_timeout(connection, connection.read_phase())
+        future = connection.stream.read_bytes(
+            self.READ_CHUNK_SIZE, partial=True,
+        )
+        future.add_done_callback(
+            functools.partial(self._on_read, connection)
+        )
 
-        byteswritten = connect.send(connection.response)
-        if byteswritten:
-            connection.response = connection.response[byteswritten:]
+    def _on_read(self, connection, future):
+        if connection.stream.closed() or connection.parser is None:
+            return
 
-        if not len(connection.response):
-            self._close(connect)
+        if self.metrics is not None:
+            self.bytes_received.inc(len(future.result))
+        connection.feed(future.result)
+        if connection.requests:
+            self._respond(connection)
+        else:
+            self._read_request(connection)
+
+    def _respond(self, connection):
+        # pipelined requests are answered in order through the write
+        # queue, the next read starts once all of them are flushed
+        self._arm_timeout(connection, self.WRITING)
+        while connection.requests:
+            connection.reset()
+            response = self.handle(connection)
+            if isinstance(response, Future):
+                # parked, neither read nor written until the handler is
+                # done or its timeout answers for it
+                connection.parked = response
+                self._arm_timeout(connection, self.HANDLING)
+                self.ioloop.add_future(
+                    response, functools.partial(self._on_handled, connection),
+                )
+                return
+            future = self._write_response(connection, response)
+            if future is None:
+                return
+            if not connection.keep_alive:
+                break
+        future.add_done_callback(
+            functools.partial(self._on_write, connection)
+        )
 
-    def _close(self, connect, event=None):
-        fd = connect.fileno()
-        connect.shutdown(socket.SHUT_RDWR)
-        connect.close()
+    def _on_handled(self, connection, future):
+        buffers, body = future.result
+        if connection.stream.closed() or connection.parked is not future:
+            self._close_body(body)
+            return
+        connection.parked = None
+        self._arm_timeout(connection, self.WRITING)
+        future = self._write_response(connection, (buffers, body))
+        if future is not None:
+            future.add_done_callback(
+                functools.partial(self._on_write, connection)
+            )
+
+    def _write_response(self, connection, response):
+        # the write Future, None once a streamed body has taken over
+        buffers, body = response
+        future = connection.stream.write(buffers)
+        if isinstance(body, FileWrapper):
+            # the file stays open until it is sent
+            future.add_done_callback(
+                functools.partial(self._release_file, body)
+            )
+        elif body is not None:
+            connection.last_write = future
+            self._start_stream(connection, body)
+            return None
+        return future
+
+    def _on_write(self, connection, future):
+        if self.metrics is not None:
+            self._count_sent(connection)
+        if connection.stream.closed():
+            return
+
+        if not connection.keep_alive:
+            connection.stream.close()
+        elif connection.requests:
+            self._respond(connection)
+        else:
+            self._read_request(connection)
 
-        ioloop = IOLoop.instance()
-        ioloop.remove_handler(fd)
+    def _start_stream(self, connection, body):
+        try:
+            iterator = iter(body)
+        except Exception as error:
+            access_logger.error('response body error: %r', error)
+            self._close_body(body)
+            connection.stream.close()
+            return
+        self._pump(connection, body, iterator)
+
+    def _pump(self, connection, body, iterator, future=None):
+        stream = connection.stream
+        connection.pending = None
+        resume = functools.partial(self._pump, connection, body, iterator)
+        while True:
+            if stream.closed():
+                self._close_body(body)
+                return
+            if stream.write_buffer_size > self.STREAM_HIGH_WATER:
+                connection.last_write.add_done_callback(resume)
+                return
+
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            except Exception as error:
+                # the status line is already sent, all we can do is to
+                # cut the response short
+                access_logger.error('response body error: %r', error)
+                self._close_body(body)
+                stream.close()
+                return
+
+            if isinstance(chunk, Future):
+                # the body has nothing to send until this resolves
+                if not chunk.done:
+                    connection.pending = chunk
+                    chunk.add_done_callback(resume)
+                    return
+                continue
+            if not chunk:
+                continue
+            if connection.chunked:
+                chunk = ['%x\r\n' % len(chunk), chunk, '\r\n']
+            connection.last_write = stream.write(chunk)
+
+        self._close_body(body)
+        if connection.chunked:
+            connection.last_write = stream.write('0\r\n\r\n')
+        connection.last_write.add_done_callback(
+            functools.partial(self._on_write, connection)
+        )
 
-        del self.conn_pool[fd]
+    def _release_file(self, body, future):
+        self._close_body(body)
+
+    @staticmethod
+    def _close_body(body):
+        # required by PEP 3333 for iterables that provide close()
+        close = getattr(body, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception as error:
+                access_logger.error('response body close error: %r', error)
+
+    def _count_sent(self, connection):
+        written = connection.stream.bytes_written
+        self.bytes_sent.inc(written - connection.bytes_counted)
+        connection.bytes_counted = written
+
+    def _on_close(self, connection):
+        if self.metrics is not None:
+            self._count_sent(connection)
+        self.timer_wheel.cancel(connection)
+        self.conn_pool.pop(connection.fd, None)
+        if (self.max_connections is not None and
+                len(self.conn_pool) < self.max_connections):
+            self._resume_accepting()
+        if self.stopping and not self.conn_pool:
+            self.ioloop.stop()
+
+    def stop(self):
+        if self.stopping:
+            return
+        self._pause_accepting()
+        self.stopping = True
+        self.ssocket.close()
+
+        # in-flight requests are finished, idle keep-alive ones dropped
+        for connection in self.conn_pool.values():
+            if connection.idle:
+                connection.stream.close()
+        if not self.conn_pool:
+            self.ioloop.stop()
+
+    def should_keep_alive(self, environ, connection):
+        if self.stopping or connection.parser is None:
+            return False
+        if connection.requests_handled >= self.max_keepalive_requests:
+            return False
+
+        for name, value in connection.headers:
+            if name.lower() == 'connection' and value.lower() == 'close':
+                return False
+
+        token = environ.get('HTTP_CONNECTION', '').lower()
+        if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+            return token != 'close'
+        return token == 'keep-alive'
 
     def serve_forever(self):
-        self.ioloop.add_handler(self.ssocket, self._accept,
-                                IOLoop.READ | IOLoop.ERROR)
+        self._resume_accepting()
         try:
             self.ioloop.start()
         finally:
             self.ssocket.close()
+            self.access_log.close()
+
+    def default_headers(self):
+        utc_now = datetime.utcnow().strftime(self.HEADER_DATE_FORMAT)
+        return [
+            ('Date', utc_now),
+            ('Server', self.SERVER_NAME),
+        ]
 
     def handle(self, connection):
         def start_response(status, response_headers, exc_info=False):
-            utc_now = datetime.utcnow().strftime(self.HEADER_DATE_FORMAT)
-            connection.headers = response_headers + [
-                ('Date', utc_now),
-                ('Server', self.SERVER_NAME),
-            ]
+            connection.headers = response_headers + self.default_headers()
             connection.status = status
 
-        request_text = ''.join(connection.request_buffer)
-        environ = self.get_environ(request_text)
-        body = self.application(environ, start_response)
-        connection.response = self.package_response(body, connection)
-
-        request_line = request_text.splitlines()[0]
-        access_logger.info(
-            '%s "%s" %s %s', connection.address[0], request_line,
-            connection.status.split(' ', 1)[0], len(body[0]),
-        )
-        access_logger.debug('\n' + ''.join(
-            '< {line}\n'.format(line=line)
-            for line in request_text.splitlines()
-        ))
-
-    @classmethod
-    def parse_request_buffer(cls, text):
-        content_lines = text.splitlines()
+        request = connection.requests.popleft()
+        if isinstance(request, HTTPError):
+            return self.handle_error(connection, request)
 
-        request_line = content_lines[0].rstrip('\r\n')
-        request_method, path, request_version = request_line.split()
-        if '?' in path:
-            path, query_string = path.split('?', 1)
+        started = time.time()
+        environ = self.get_environ(request)
+        try:
+            body = self.application(environ, start_response)
+        except Exception as error:
+            access_logger.error('application error: %r', error, exc_info=True)
+            return self.handle_error(
+                connection, HTTPError(500, 'Internal Server Error'),
+            )
+        if isinstance(body, Future):
+            # an application still waiting on its handler returns a
+            # Future of the body, the response Future resolves after it
+            if not body.done:
+                response = Future()
+                body.add_done_callback(lambda future: response.set_result(
+                    self.package(connection, request, environ,
+                                 future.result, started)
+                ))
+                return response
+            body = body.result
+        return self.package(connection, request, environ, body, started)
+
+    def package(self, connection, request, environ, body, started):
+        connection.requests_handled += 1
+        connection.keep_alive = self.should_keep_alive(environ, connection)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            response = self.package_head(body, connection), None
+            self._close_body(body)
+        elif connection.status.startswith(_BODILESS_STATUSES):
+            # whatever the application meant to stream, a 1xx, 204 or 304
+            # ends with its headers and has no chunked framing
+            response = self.package_response([], connection), None
+            self._close_body(body)
+        elif isinstance(body, FileWrapper) and body.fileno() is not None:
+            response = self.package_file(body, connection), body
+        elif isinstance(body, (list, tuple)):
+            response = self.package_response(body, connection), None
+            self._close_body(body)
         else:
-            path, query_string = path, ''
-
-        return {
-            'PATH_INFO': path,
-            'REQUEST_METHOD': request_method,
-            'SERVER_PROTOCOL': request_version,
-            'QUERY_STRING': query_string,
-        }
+            response = self.package_stream(environ, connection), body
+
+        if self.access_log.enabled():
+            self.access_log.log((
+                started, connection.address[0], environ['REQUEST_METHOD'],
+                environ['REQUEST_URI'], environ['SERVER_PROTOCOL'],
+                connection.status.split(' ', 1)[0],
+                connection.content_length, time.time() - started,
+            ))
+        if access_logger.isEnabledFor(logging.DEBUG):
+            access_logger.debug('\n' + ''.join(
+                '< {0}: {1}\n'.format(key, value)
+                for key, value in sorted(request.items())
+                if key.startswith('HTTP_')
+            ))
+        return response
 
-    def get_environ(self, request_text):
-        request_data = self.parse_request_buffer(request_text)
+    def handle_error(self, connection, error):
+        connection.status = error.status
+        connection.headers = [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+        ] + self.default_headers()
+        connection.keep_alive = False
+        response = self.package_response([error.status], connection)
+        if self.access_log.enabled():
+            self.access_log.log((
+                time.time(), connection.address[0], '-', '-', '-',
+                '%d' % error.code, connection.content_length, 0.0,
+            ))
+        return response, None
+
+    def get_environ(self, request_data):
         scheme = request_data['SERVER_PROTOCOL'].split('/')[1].lower(),
         environ = {
             'wsgi.version': (1, 0),
             'wsgi.url_scheme': scheme,
-            'wsgi.input': StringIO.StringIO(request_text),
             'wsgi.errors': sys.stderr,
             'wsgi.multithread': False,
-            'wsgi.multiprocess': False,
+            'wsgi.multiprocess': self.multiprocess,
             'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
             'SERVER_NAME': self.server_name,
             'SERVER_PORT': self.server_port,
         }
@@ -188,21 +910,108 @@ class WSGIServer(object):
         return environ
 
     def package_response(self, body, connection):
-        response = 'HTTP/1.1 {status}\r\n'.format(status=connection.status)
-        for header in connection.headers:
-            response += '{0}: {1}\r\n'.format(*header)
-        response += '\r\n'
-        for data in body:
-            response += data
-        access_logger.debug('\n' + ''.join(
-            '> {line}\n'.format(line=line)
-            for line in response.splitlines()
-        ))
-        return response
+        # the header block and the body chunks stay separate buffers and
+        # are handed to the stream's write queue as they are
+        if connection.status.startswith(_BODILESS_STATUSES):
+            body = []
+        body = [data for data in body if data]
+        connection.content_length = sum(len(data) for data in body)
+        return [self.build_header_block(
+            connection, self.framed_headers(connection),
+        )] + body
+
+    def package_file(self, body, connection):
+        fd = body.fileno()
+        buffers = []
+        for part in body.ranges:
+            if not isinstance(part, str):
+                offset, length = part
+                if length is None:
+                    length = max(0, os.fstat(fd).st_size - offset)
+                part = FileSegment(fd, offset, length)
+            if part:
+                buffers.append(part)
+        connection.content_length = sum(len(part) for part in buffers)
+        return [self.build_header_block(
+            connection, self.framed_headers(connection),
+        )] + buffers
+
+    def package_head(self, body, connection):
+        # the Content-Length of a HEAD reply describes the body a GET
+        # would get, which the application may have set itself
+        for name, value in connection.headers:
+            if name.lower() == 'content-length':
+                connection.content_length = int(value)
+        if (connection.content_length is None and
+                isinstance(body, (list, tuple))):
+            connection.content_length = sum(len(data) for data in body)
+        return [self.build_header_block(
+            connection, self.framed_headers(connection),
+        )]
+
+    def framed_headers(self, connection):
+        headers = [
+            header for header in connection.headers
+            if header[0].lower() not in _FRAMING_HEADERS
+        ]
+        if (connection.content_length is not None and
+                not connection.status.startswith(_BODILESS_STATUSES)):
+            headers.append(('Content-Length', connection.content_length))
+        return headers
+
+    def package_stream(self, environ, connection):
+        headers = []
+        for name, value in connection.headers:
+            key = name.lower()
+            if key == 'content-length':
+                connection.content_length = int(value)
+            if key not in ('connection', 'transfer-encoding'):
+                headers.append((name, value))
+
+        if connection.content_length is None:
+            if environ['SERVER_PROTOCOL'] == 'HTTP/1.1':
+                connection.chunked = True
+                headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # HTTP/1.0 bodies of unknown length end with the connection
+                connection.keep_alive = False
+        return [self.build_header_block(connection, headers)]
+
+    def build_header_block(self, connection, headers):
+        lines = ['HTTP/1.1 %s' % connection.status]
+        for header in headers:
+            lines.append('%s: %s' % header)
+        lines.append(
+            'Connection: %s' % ('keep-alive' if connection.keep_alive
+                                else 'close')
+        )
+        lines.append('\r\n')
+
+        if access_logger.isEnabledFor(logging.DEBUG):
+            access_logger.debug('\n' + ''.join(
+                '> {line}\n'.format(line=line) for line in lines[:-1]
+            ))
+        return '\r\n'.join(lines)
 
 
-def make_server(host, port, application):
+def make_server(host, port, application, **kwargs):
     server_address = (host, port)
-    server = WSGIServer(server_address)
+    server = WSGIServer(server_address, **kwargs)
     server.set_app(application)
     return server
+
+
+def serve_worker(host, port, application, **kwargs):
+    # every worker process owns an IOLoop and a SO_REUSEPORT socket,
+    # the kernel balances new connections between them
+    IOLoop.clear_instance()
+    server = make_server(host, port, application, **kwargs)
+    server.multiprocess = True
+    # the handler may run in the middle of a loop iteration, the stop
+    # waits for the loop to pick it up
+    signal.signal(
+        signal.SIGTERM,
+        lambda signum, frame: server.ioloop.add_callback_from_signal(
+            server.stop),
+    )
+    server.serve_forever()
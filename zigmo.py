@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 
 import re
+import time
 import urllib
+import urlparse
+import functools
+import traceback
+import collections
 
 # from wsgiref.simple_server import make_server
-from wsgi_server import make_server
+from wsgi_server import make_server, serve_worker, environ_key, HEADER_LISTS
+from process import fork_workers
 from concurrent import Future
+from util import SegmentedLRUCache
 
 
 _RESPONSE_STATUSES = {
@@ -113,9 +120,13 @@ _RESPONSE_HEADERS = (
     'X-UA-Compatible',
 )
 
-_UPPER_CASE_RESPONSE_HEADERS = (header.upper() for header in _RESPONSE_HEADERS)
+_UPPER_CASE_RESPONSE_HEADERS = dict(
+    (header.upper(), header) for header in _RESPONSE_HEADERS
+)
 _HEADER_X_POWERED_BY = {'X-Powered-By': 'zigmo/0.1'}
 
+_MISSING = object()
+
 
 # Error Processing
 
@@ -150,11 +161,64 @@ def quote(s, encoding='utf-8'):
     return urllib.quote(s)
 
 
+class HTTPHeaders(object):
+    # the request headers of a WSGI environ looked up by name in any case,
+    # nothing is copied out of environ. a header sent more than once reads
+    # as its values joined by ',', get_list returns them apart
+    __slots__ = ('_environ',)
+
+    def __init__(self, environ):
+        self._environ = environ
+
+    def __getitem__(self, name):
+        try:
+            return self._environ[environ_key(name)]
+        except KeyError:
+            raise KeyError(name)
+
+    def get(self, name, default=None):
+        return self._environ.get(environ_key(name), default)
+
+    def __contains__(self, name):
+        return environ_key(name) in self._environ
+
+    def get_list(self, name):
+        key = environ_key(name)
+        repeated = self._environ.get(HEADER_LISTS)
+        if repeated and key in repeated:
+            return list(repeated[key])
+        value = self._environ.get(key)
+        return [] if value is None else [value]
+
+    def keys(self):
+        names = []
+        for key in self._environ:
+            if key.startswith('HTTP_'):
+                key = key[5:]
+            elif key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                continue
+            names.append(key.replace('_', '-').title())
+        return names
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'HTTPHeaders(%r)' % dict(self.items())
+
+
 class Request(object):
     def __init__(self, environ):
         self._environ = environ
-        self._headers = {}
-        self._cookies = {}
+        self._headers = None
+        self._cookies = None
+        self._arguments = None
 
     @property
     def url(self):
@@ -176,32 +240,115 @@ class Request(object):
     def cookies(self):
         return self._get_cookies()
 
+    @property
+    def arguments(self):
+        return self._get_arguments()
+
     def get_cookie(self, name, default=None):
-        pass
+        return self._get_cookies().get(name, default)
+
+    def get_argument(self, name, default=None):
+        # the last value of a repeated query argument
+        values = self._get_arguments().get(name)
+        return values[-1] if values else default
+
+    def get_arguments(self, name):
+        return list(self._get_arguments().get(name, ()))
 
     def _get_cookies(self):
-        if not self._cookies:
+        if self._cookies is None:
             cookies = {}
-            cookie_str = self._environ.get('HTTP_COOKIE')
-            if cookie_str:
-                for cookie in cookie_str.split('; '):
-                    if '=' in cookie:
-                        k, v = cookie.split('=')
-                        cookies[k] = v
+            for header in self._get_headers().get_list('Cookie'):
+                quoted = '"' in header
+                for cookie in header.split(';'):
+                    name, sep, value = cookie.partition('=')
+                    name = name.strip()
+                    if sep and name:
+                        value = value.strip()
+                        if quoted and len(value) > 1 and \
+                                value[0] == value[-1] == '"':
+                            value = value[1:-1]
+                        cookies[name] = value
             self._cookies = cookies
         return self._cookies
 
+    def _get_arguments(self):
+        if self._arguments is None:
+            self._arguments = urlparse.parse_qs(
+                self.query_string, keep_blank_values=True,
+            )
+        return self._arguments
+
     def _get_headers(self):
-        if not self._headers:
-            headers = {}
-            for k, v in self._environ.items():
-                if k.startswith('HTTP_'):
-                    key = k[5:].replace('_', '-').upper()
-                    headers[key] = v.encode('utf-8')
-            self._headers = headers
+        if self._headers is None:
+            self._headers = HTTPHeaders(self._environ)
         return self._headers
 
 
+class ResponseStream(object):
+    # a WSGI body fed by Response.write(), the server pulls chunks only
+    # when the socket can take more and waits on the yielded Future when
+    # nothing has been written yet
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.finished = False
+        self.aborted = False
+        self._waiter = None
+
+    def write(self, chunk):
+        self.chunks.append(to_string(chunk))
+        self._wake()
+
+    def flush(self):
+        # resolved once the server has pulled everything written before
+        future = Future()
+        self.chunks.append(future)
+        self._wake()
+        return future
+
+    def finish(self):
+        self.finished = True
+        self._wake()
+
+    def abort(self):
+        # the handler failed after the status line went out, the server
+        # cuts the response short instead of ending it
+        self.aborted = True
+        self.close()
+        self._wake()
+
+    def _wake(self):
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            waiter.set_result(None)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.chunks:
+            chunk = self.chunks.popleft()
+            if isinstance(chunk, Future):
+                chunk.set_result(None)
+                continue
+            return chunk
+        if self.aborted:
+            raise HandlerError()
+        if self.finished:
+            raise StopIteration()
+        self._waiter = Future()
+        return self._waiter
+
+    __next__ = next
+
+    def close(self):
+        self.finished = True
+        while self.chunks:
+            chunk = self.chunks.popleft()
+            if isinstance(chunk, Future):
+                chunk.set_result(None)
+
+
 class Response(object):
     def __init__(self):
         self._status = '200 OK'
@@ -209,6 +356,26 @@ class Response(object):
         self._headers.update(_HEADER_X_POWERED_BY)
         self._cookies = {}
         self._body = {}
+        self._stream = None
+        # called when the first write() or flush() opens the stream
+        self.on_stream = None
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def write(self, chunk):
+        self._open_stream().write(chunk)
+
+    def flush(self):
+        return self._open_stream().flush()
+
+    def _open_stream(self):
+        if self._stream is None:
+            self._stream = ResponseStream()
+            if self.on_stream is not None:
+                self.on_stream()
+        return self._stream
 
     def set_response_code(self, code):
         if code not in _RESPONSE_STATUSES:
@@ -216,11 +383,17 @@ class Response(object):
         self._status = '%s %s' % (code, _RESPONSE_STATUSES[code])
 
     def set_header(self, name, value):
-        key = name.upper()
-        if key not in _UPPER_CASE_RESPONSE_HEADERS:
-            key = name
+        key = _UPPER_CASE_RESPONSE_HEADERS.get(name.upper(), name)
         self._headers[key] = to_string(value)
 
+    def get_header(self, name, default=None):
+        key = _UPPER_CASE_RESPONSE_HEADERS.get(name.upper(), name)
+        return self._headers.get(key, default)
+
+    def clear_header(self, name):
+        key = _UPPER_CASE_RESPONSE_HEADERS.get(name.upper(), name)
+        self._headers.pop(key, None)
+
     @property
     def status(self):
         return self._status
@@ -255,17 +428,80 @@ class Response(object):
 class Controller(object):
     ALLOWED_METHOD = ['get', 'post', 'put', 'patch', 'delete', 'head']
 
+    # <int:id> style url parameters, <name> defaults to str
+    CONVERTERS = {
+        'str': (r'[^/]+', str),
+        'int': (r'\d+', int),
+        'float': (r'\d+(?:\.\d+)?', float),
+        'path': (r'.+', str),
+    }
+    CONVERTER_PATTERN = re.compile(
+        r'(?<!\?P)<(?:(?P<converter>\w+):)?(?P<name>\w+)>'
+    )
+    # backreferences and inline flags can't be merged into one regex
+    UNMERGEABLE_PATTERN = re.compile(r'\(\?P=|\\[1-9]|\(\?[aiLmsux]')
+    REGEX_META = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
     def __init__(self, url_regex, handler):
-        self.url_regex = self.compile_url_pattern(url_regex)
+        self.url_pattern = url_regex
+        self.pattern, self.converters = self.expand_url_pattern(url_regex)
+        self.url_regex = self.compile_url_pattern(self.pattern)
+        self.params = [
+            (index, name, self.converters.get(name, str))
+            for name, index in self.url_regex.groupindex.items()
+        ]
+        self.literal = self.literal_path(url_regex)
         self.handler = handler
         self.methods = self.collect_method()
 
+    @classmethod
+    def expand_url_pattern(cls, url_pattern):
+        converters = {}
+
+        def expand(match):
+            converter = match.group('converter') or 'str'
+            if converter not in cls.CONVERTERS:
+                raise ValueError('unknown url converter: %s' % converter)
+            regex, converters[match.group('name')] = cls.CONVERTERS[converter]
+            return '(?P<%s>%s)' % (match.group('name'), regex)
+
+        return cls.CONVERTER_PATTERN.sub(expand, url_pattern), converters
+
     @classmethod
     def compile_url_pattern(cls, url_regex):
-        if not url_regex.startswith('$'):
+        if not url_regex.endswith('$'):
             url_regex += '$'
         return re.compile(url_regex)
 
+    @classmethod
+    def literal_path(cls, url_pattern):
+        path = url_pattern
+        if path.startswith('^'):
+            path = path[1:]
+        if path.endswith('$'):
+            path = path[:-1]
+        if cls.REGEX_META.search(path) or cls.CONVERTER_PATTERN.search(path):
+            return None
+        return path
+
+    @property
+    def mergeable(self):
+        return not self.UNMERGEABLE_PATTERN.search(self.url_regex.pattern)
+
+    @property
+    def merge_pattern(self):
+        # group numbering is kept, only the names are dropped so that
+        # several routes may use the same parameter name
+        return re.sub(r'\(\?P<\w+>', '(', self.url_regex.pattern)
+
+    def extract_params(self, match, offset=0):
+        params = {}
+        for index, name, converter in self.params:
+            value = match.group(index + offset)
+            if value is not None:
+                params[name] = converter(value)
+        return params
+
     def collect_method(self):
         # desert use hasattr()
         # refer: https://hynek.me/articles/hasattr/
@@ -284,10 +520,114 @@ class Controller(object):
         return handler_methods
 
 
+class Router(object):
+    # python 2 re supports at most 100 groups per pattern
+    MAX_GROUPS = 99
+
+    def __init__(self, controllers):
+        self.controllers = controllers
+        self.static = {}
+        self.matchers = []
+        self.compile()
+
+    def compile(self):
+        static = {}
+        dynamic = []
+        for controller in self.controllers:
+            path = controller.literal
+            if path is None:
+                dynamic.append(controller)
+            elif path not in static and not any(
+                    earlier.url_regex.match(path) for earlier in dynamic):
+                # a literal route only wins when no earlier route matches it
+                static[path] = controller
+
+        matchers = []
+        chunk = []
+        groups = 0
+        for controller in dynamic:
+            size = controller.url_regex.groups + 1
+            if not controller.mergeable or size > self.MAX_GROUPS:
+                matchers.append(self.merge_routes(chunk))
+                matchers.append((controller.url_regex, controller))
+                chunk, groups = [], 0
+                continue
+            if groups + size > self.MAX_GROUPS:
+                matchers.append(self.merge_routes(chunk))
+                chunk, groups = [], 0
+            chunk.append(controller)
+            groups += size
+        matchers.append(self.merge_routes(chunk))
+
+        self.static = static
+        self.matchers = [matcher for matcher in matchers if matcher]
+
+    @staticmethod
+    def merge_routes(controllers):
+        if not controllers:
+            return None
+
+        patterns = []
+        routes = {}
+        group = 1
+        for controller in controllers:
+            patterns.append('(%s)' % controller.merge_pattern)
+            # the route's outer group closes last, so it becomes lastindex
+            routes[group] = controller
+            group += controller.url_regex.groups + 1
+        return re.compile('|'.join(patterns)), routes
+
+    def match(self, path):
+        controller = self.static.get(path)
+        if controller is not None:
+            return controller, {}
+
+        for regex, routes in self.matchers:
+            match = regex.match(path)
+            if match is None:
+                continue
+            if isinstance(routes, Controller):
+                return routes, routes.extract_params(match)
+            index = match.lastindex
+            return routes[index], routes[index].extract_params(match, index)
+        return None, None
+
+
 class Application(object):
-    def __init__(self, url_handler):
-        self.url_handler = url_handler
+    def __init__(self, url_handler, dispatch_cache_size=None,
+                 compressor=None, response_cache=None, metrics=None):
+        self.url_handler = list(url_handler)
         self.url_spec = self.build_url_spec()
+        self.router = Router(self.url_spec)
+
+        self.dispatch_cache = None
+        if dispatch_cache_size:
+            self.dispatch_cache = SegmentedLRUCache(dispatch_cache_size)
+        # e.g. compression.GzipCompressor, applied to every response
+        self.compressor = compressor
+        # e.g. cache.ResponseCache, consulted before a Request is built
+        self.response_cache = response_cache
+
+        # a metrics.Registry, latency and statuses are kept per route
+        self.metrics = metrics
+        if metrics is not None:
+            self.request_duration = metrics.histogram(
+                'zigmo_request_duration_seconds',
+                'Time spent producing a response', ('route',),
+            )
+            self.responses = metrics.counter(
+                'zigmo_responses_total', 'Responses by route and status',
+                ('route', 'status'),
+            )
+            # controller -> (route, duration histogram, {status: counter})
+            self.route_metrics = {}
+
+    def add_route(self, url_regex, handler):
+        self.url_handler.append((url_regex, handler))
+        self.url_spec.append(Controller(url_regex, handler))
+        self.router = Router(self.url_spec)
+        if self.dispatch_cache is not None:
+            self.dispatch_cache.clear()
 
     def build_url_spec(self):
         return [
@@ -295,20 +635,57 @@ class Application(object):
             for url_regex, handler in self.url_handler
         ]
 
+    def observe(self, controller, status, elapsed):
+        metrics = self.route_metrics.get(controller)
+        if metrics is None:
+            route = '-' if controller is None else controller.url_pattern
+            metrics = self.route_metrics[controller] = (
+                route, self.request_duration.labels(route), {},
+            )
+        route, duration, statuses = metrics
+        duration.observe(elapsed)
+        counter = statuses.get(status)
+        if counter is None:
+            counter = statuses[status] = self.responses.labels(
+                route, status.split(' ', 1)[0],
+            )
+        counter.inc()
+
     def dispatch(self, url, method):
-        for controller in self.url_spec:
-            if controller.url_regex.match(url):
-                method = method.lower()
-                if method in controller.methods:
-                    return getattr(controller.handler, method)
-                else:
-                    raise MethodNotAllowed()
-        raise HandlerNotFound()
+        cache = self.dispatch_cache
+        if cache is None:
+            return self.resolve(url, method)
+
+        # 404 and 405 outcomes are cached as their exception class
+        key = (url, method)
+        outcome = cache.get(key, _MISSING)
+        if outcome is _MISSING:
+            try:
+                outcome = self.resolve(url, method)
+            except HandlerError as error:
+                outcome = error.__class__
+            cache.set(key, outcome)
+        if isinstance(outcome, type):
+            raise outcome()
+        return outcome
+
+    def resolve(self, url, method):
+        controller, params = self.router.match(url)
+        if controller is None:
+            raise HandlerNotFound()
+
+        method = method.lower()
+        if method not in controller.methods:
+            raise MethodNotAllowed()
+        return controller, getattr(controller.handler, method), params
 
     @classmethod
-    def execute_handler(cls, func, request, response):
-        result = func(request=request, response=response)
-        if isinstance(result, Future):
+    def execute_handler(cls, func, request, response, params=None):
+        # a coroutine handler that is still waiting or has failed hands
+        # back its Future
+        result = func(request=request, response=response, **(params or {}))
+        if (isinstance(result, Future) and result.done and
+                result.exc_info is None):
             return result.result
         return result
 
@@ -324,25 +701,149 @@ def handle_error(error, response, start_response):
 
 
 def build_wsgi_app(application):
+    def finish(environ, start_response, request, response, controller, func,
+               content, started):
+        if response.stream is not None:
+            end_stream(response.stream, content)
+            body = response.stream
+        else:
+            body = build_body(content)
+        return respond(environ, start_response, request, response,
+                       controller, func, body, started)
+
+    def end_stream(stream, content):
+        # only called once the handler is done, writes made across its
+        # yields are all in the stream by then
+        if content is not None:
+            stream.write(content)
+        stream.finish()
+
+    def respond(environ, start_response, request, response, controller, func,
+                body, started):
+        if application.compressor is not None:
+            body = application.compressor.compress(request, response, body)
+        if application.response_cache is not None:
+            body = application.response_cache.store(
+                environ, func, response, body,
+            )
+
+        start_response(response.status, response.headers)
+        if started is not None:
+            application.observe(controller, response.status,
+                                time.time() - started)
+        return body
+
+    def fail(start_response, response, controller, exc_info, started):
+        traceback.print_exception(*exc_info)
+        if response.stream is not None:
+            response.stream.close()
+        body = handle_error(HandlerError(), response, start_response)
+        if started is not None:
+            application.observe(controller, response.status,
+                                time.time() - started)
+        return body
+
+    def stream(body, environ, start_response, request, response, controller,
+               func, started):
+        if not body.done:
+            body.set_result(respond(environ, start_response, request,
+                                    response, controller, func,
+                                    response.stream, started))
+
+    def resolved(body, environ, start_response, request, response,
+                 controller, func, started, future):
+        if body.done:
+            # the response is already being streamed
+            if future.exc_info is not None:
+                traceback.print_exception(*future.exc_info)
+                response.stream.abort()
+            else:
+                end_stream(response.stream, future.result)
+            return
+        if future.exc_info is not None:
+            body.set_result(fail(start_response, response, controller,
+                                 future.exc_info, started))
+        else:
+            body.set_result(finish(environ, start_response, request, response,
+                                   controller, func, future.result, started))
+
     def wsgi(environ, start_response):
+        cache = application.response_cache
+        if cache is not None:
+            entry = cache.lookup(environ)
+            if entry is not None:
+                return cache.serve(entry, environ, start_response)
+
+        # only timed when there is somewhere to report it
+        started = time.time() if application.metrics is not None else None
         request = Request(environ)
         response = Response()
 
         try:
-            func = application.dispatch(request.url, request.method)
-            content = application.execute_handler(func, request, response)
+            controller, func, params = application.dispatch(
+                request.url, request.method,
+            )
+            content = application.execute_handler(
+                func, request, response, params,
+            )
         except (HandlerNotFound, MethodNotAllowed) as error:
-            return handle_error(error, response, start_response)
-
-        start_response(response.status, response.headers)
-        del request
-        del response
-        return [content]
+            body = handle_error(error, response, start_response)
+            if started is not None:
+                application.observe(None, response.status,
+                                    time.time() - started)
+            return body
+
+        if not isinstance(content, Future):
+            return finish(environ, start_response, request, response,
+                          controller, func, content, started)
+        if content.exc_info is not None:
+            return fail(start_response, response, controller,
+                        content.exc_info, started)
+
+        # the server parks the connection on the returned Future and takes
+        # its result as the body once the handler's coroutine is done, or
+        # as soon as the handler starts writing, a flush() would otherwise
+        # wait on a body the server never pulls
+        body = Future()
+        streaming = functools.partial(
+            stream, body, environ, start_response, request, response,
+            controller, func, started,
+        )
+        if response.stream is not None:
+            streaming()
+        else:
+            response.on_stream = streaming
+        content.add_done_callback(functools.partial(
+            resolved, body, environ, start_response, request, response,
+            controller, func, started,
+        ))
+        return body
     return wsgi
 
 
-def run_server(host='localhost', port=9090, application=None):
+def build_body(content):
+    if content is None:
+        return []
+    if isinstance(content, (str, unicode)):
+        return [to_string(content)]
+    if isinstance(content, (list, tuple)):
+        return [to_string(data) for data in content]
+    if hasattr(content, '__iter__'):
+        # generators and other iterables are streamed by the server
+        return content
+    return [to_string(content)]
+
+
+def run_server(host='localhost', port=9090, application=None, workers=1,
+               **kwargs):
     print 'Running server on %s:%s' % (host, port)
     wsgi = build_wsgi_app(application)
-    server = make_server(host, port, wsgi)
+    if application.metrics is not None:
+        kwargs.setdefault('metrics', application.metrics)
+    if workers > 1:
+        fork_workers(
+            lambda: serve_worker(host, port, wsgi, **kwargs), workers,
+        )
+        return
+    server = make_server(host, port, wsgi, **kwargs)
     server.serve_forever()